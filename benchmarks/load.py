@@ -0,0 +1,304 @@
+"""Load tests the chat API. The server is staged from `src/backend` into a
+temporary directory and started in its own process on the local storage, so
+no database is needed. Thousands of simulated clients then run a weighted mix
+of operations against it for a while, and the throughput and latency of each
+operation are reported.
+
+```
+python benchmarks/load.py --clients 2000 --duration 30 \
+	--mix post=1,page=6,poll=2,static=1 --json results.json
+```
+"""
+
+from gevent import monkey; monkey.patch_all()
+
+from gevent import joinall, sleep, spawn
+from argparse import ArgumentParser, Namespace
+from base64 import b64encode
+from http.client import HTTPConnection
+from json import dumps, loads
+from random import Random
+from subprocess import DEVNULL, Popen, run
+from time import monotonic, perf_counter, time
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import resource
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+operations = ("post", "page", "poll", "static")
+
+# Run by the server process, which seeds the storage before serving.
+server_script = """
+import sys, server_impl
+from server_impl.database import Channel, User, open_database, set_channel, \
+	set_user
+open_database()
+users, channels = int(sys.argv[1]), int(sys.argv[2])
+for ind in range(users):
+	set_user(User(f"bench_{ind}", "password"))
+for ind in range(1, channels):
+	set_channel(Channel("bench", f"channel_{ind}"))
+server_impl.main()
+"""
+
+def stage(directory: str):
+	"""Lays out the server like the makefile does, without the Rust launcher.
+	"""
+
+	shutil.copytree(os.path.join(repository, "src", "backend"),
+		os.path.join(directory, "server_impl"),
+		ignore = shutil.ignore_patterns("__pycache__", "*.rs"))
+	assets = os.path.join(directory, "assets")
+	os.makedirs(assets)
+	for name in os.listdir(os.path.join(repository, "src", "html")):
+		shutil.copy(os.path.join(repository, "src", "html", name), assets)
+	for name in ("frontendmap.json", "statuscodes.json"):
+		shutil.copy(os.path.join(repository, "src", name), directory)
+
+def start_server(directory: str, args: Namespace) -> Popen:
+	env = {
+		**os.environ,
+		"PORT": str(args.port),
+		"STORAGE": "local",
+		"LOCAL_STORAGE_PATH": os.path.join(directory, "data"),
+		"MESSAGE_WRITE_MODE": args.write_mode,
+		"MAX_EVENT_STREAMS": str(args.clients),
+		# The limits are for abusive clients, not for measuring throughput.
+		"MAX_ACTIVE_REQUESTS": str(args.clients),
+		"MAX_LONG_POLLS_PER_USER": str(args.clients),
+		"MESSAGE_RATE": str(args.clients),
+		"MESSAGE_BURST": str(args.clients)
+	}
+	server = Popen([sys.executable, "-c", server_script, str(args.users),
+		str(args.channels)], cwd = directory, env = env,
+		stdout = None if args.verbose else DEVNULL,
+		stderr = None if args.verbose else DEVNULL)
+
+	deadline = monotonic() + 60
+	while monotonic() < deadline:
+		if server.poll() is not None:
+			raise RuntimeError("The server exited while starting.")
+		try:
+			socket.create_connection(("127.0.0.1", args.port), 1).close()
+			return server
+		except OSError:
+			sleep(0.2)
+	server.kill()
+	raise RuntimeError("The server didn't start in time.")
+
+def parse_mix(raw: str) -> Dict[str, float]:
+	mix = {}
+	for part in raw.split(","):
+		name, _, weight = part.partition("=")
+		if name not in operations:
+			raise ValueError(f"Unknown operation {name!r}.")
+		mix[name] = float(weight or 1)
+	return mix
+
+def percentile(ordered: List[float], fraction: float) -> float:
+	if len(ordered) == 0:
+		return 0.0
+	return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+class Results:
+	"""The latency of every finished operation, and the errors, by operation.
+	"""
+
+	def __init__(self):
+		self.latencies: Dict[str, List[float]] = {name: [] for name in operations}
+		self.errors: Dict[str, int] = {name: 0 for name in operations}
+
+	def summary(self, duration: float) -> Dict[str, Any]:
+		summary = {}
+		for name in operations:
+			ordered = sorted(self.latencies[name])
+			if len(ordered) == 0 and self.errors[name] == 0:
+				continue
+			summary[name] = {
+				"count": len(ordered),
+				"errors": self.errors[name],
+				"throughput": len(ordered) / duration,
+				"p50": percentile(ordered, 0.50) * 1000,
+				"p95": percentile(ordered, 0.95) * 1000,
+				"p99": percentile(ordered, 0.99) * 1000,
+				"max": (ordered[-1] if len(ordered) > 0 else 0.0) * 1000
+			}
+		return summary
+
+class Client:
+	"""A simulated user with one keep-alive connection, running random
+	operations from the mix until the deadline.
+	"""
+
+	def __init__(self, ind: int, args: Namespace, mix: Dict[str, float],
+			results: Results):
+		self.args = args
+		self.results = results
+		self.random = Random(args.seed + ind)
+		self.names = list(mix)
+		self.weights = [mix[name] for name in self.names]
+		self.channel = self.random.randrange(args.channels)
+		name = f"bench_{ind % args.users}"
+		self.authorization = "Basic " + \
+			b64encode(f"{name}:password".encode("utf-8")).decode("ascii")
+		self.cursor: Optional[str] = None
+		self.connection: Optional[HTTPConnection] = None
+
+	@property
+	def messages_path(self) -> str:
+		if self.channel == 0:
+			return "/api/v1/communities/_/channels/_/messages"
+		return f"/api/v1/communities/bench/channels/channel_{self.channel}/messages"
+
+	def request(self, method: str, path: str, body: Optional[bytes] = None,
+			headers: Dict[str, str] = {}) -> Tuple[int, bytes]:
+		if self.connection is None:
+			self.connection = HTTPConnection("127.0.0.1", self.args.port,
+				timeout = 90)
+		try:
+			self.connection.request(method, path, body, headers)
+			response = self.connection.getresponse()
+			return response.status, response.read()
+		except Exception:
+			self.connection.close()
+			self.connection = None
+			raise
+
+	def run_operation(self, name: str) -> int:
+		auth = {"Authorization": self.authorization}
+		if name == "post":
+			content = dumps({"content": f"load {self.random.random()}"})
+			return self.request("POST", self.messages_path,
+				content.encode("utf-8"), auth)[0]
+		if name == "page":
+			# Mostly the newest page, sometimes scrolling further back.
+			query = "?limit=50"
+			if self.cursor is not None and self.random.random() < 0.5:
+				query += "&cursor=" + self.cursor
+			status, body = self.request("GET", self.messages_path + query, None,
+				auth)
+			if status == 200:
+				self.cursor = loads(body).get("next")
+			return status
+		if name == "poll":
+			return self.request("GET", self.messages_path + f"?after={time()}",
+				None, auth)[0]
+		return self.request("GET", "/", None, {"Accept-Encoding": "gzip"})[0]
+
+	def run(self, start: float, deadline: float):
+		sleep(self.random.random() * self.args.ramp)
+		while monotonic() < deadline:
+			name = self.random.choices(self.names, self.weights)[0]
+			started = monotonic()
+			began = perf_counter()
+			try:
+				status = self.run_operation(name)
+			except Exception:
+				status = 0
+			elapsed = perf_counter() - began
+
+			# Only operations run between the ramp up and the deadline are measured.
+			if started - start >= self.args.ramp and monotonic() <= deadline:
+				if 200 <= status < 400:
+					self.results.latencies[name].append(elapsed)
+				else:
+					self.results.errors[name] += 1
+			if status == 0:
+				sleep(0.1)
+
+		if self.connection is not None:
+			self.connection.close()
+
+def print_summary(summary: Dict[str, Any]):
+	print(f"{'operation':<10}{'count':>9}{'errors':>8}{'ops/s':>10}" +
+		f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+	for name, stats in summary.items():
+		print(f"{name:<10}{stats['count']:>9}{stats['errors']:>8}" +
+			f"{stats['throughput']:>10.1f}{stats['p50']:>10.2f}" +
+			f"{stats['p95']:>10.2f}{stats['p99']:>10.2f}{stats['max']:>10.2f}")
+
+def git_revision() -> Optional[str]:
+	try:
+		result = run(["git", "rev-parse", "HEAD"], cwd = repository,
+			capture_output = True, text = True)
+	except OSError:
+		return None
+	return result.stdout.strip() if result.returncode == 0 else None
+
+def main():
+	parser = ArgumentParser(description = "Load tests the chat API.")
+	parser.add_argument("--clients", type = int, default = 1000,
+		help = "concurrent simulated clients")
+	parser.add_argument("--duration", type = float, default = 30,
+		help = "seconds to measure for, after ramping up")
+	parser.add_argument("--ramp", type = float, default = 5,
+		help = "seconds over which clients start")
+	parser.add_argument("--mix", default = "post=1,page=6,poll=2,static=1",
+		help = "weights of the operations, from " + ", ".join(operations))
+	parser.add_argument("--users", type = int, default = 100)
+	parser.add_argument("--channels", type = int, default = 4)
+	parser.add_argument("--write-mode", default = "sync",
+		choices = ("sync", "behind", "batched"))
+	parser.add_argument("--port", type = int, default = 18090)
+	parser.add_argument("--seed", type = int, default = 0)
+	parser.add_argument("--json", help = "also write the results to this file")
+	parser.add_argument("--verbose", action = "store_true",
+		help = "show the server's output")
+	args = parser.parse_args()
+	mix = parse_mix(args.mix)
+
+	# Every client needs a socket, on both ends.
+	_, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+	directory = tempfile.mkdtemp(prefix = "chat-bench-")
+	server = None
+	try:
+		stage(directory)
+		server = start_server(directory, args)
+
+		results = Results()
+		start = monotonic()
+		deadline = start + args.ramp + args.duration
+		clients = [Client(ind, args, mix, results) for ind in range(args.clients)]
+		greenlets = [spawn(client.run, start, deadline) for client in clients]
+		# Long polls can outlive the deadline by up to a minute.
+		joinall(greenlets, timeout = deadline - monotonic() + 5)
+		for greenlet in greenlets:
+			greenlet.kill(block = False)
+		summary = results.summary(args.duration)
+	finally:
+		if server is not None:
+			server.send_signal(signal.SIGTERM)
+			try:
+				server.wait(10)
+			except Exception:
+				server.kill()
+		shutil.rmtree(directory, ignore_errors = True)
+
+	print_summary(summary)
+	if args.json is not None:
+		with open(args.json, "w") as file:
+			file.write(dumps({
+				"revision": git_revision(),
+				"time": time(),
+				"config": {
+					"clients": args.clients,
+					"duration": args.duration,
+					"ramp": args.ramp,
+					"mix": mix,
+					"users": args.users,
+					"channels": args.channels,
+					"write_mode": args.write_mode,
+					"seed": args.seed
+				},
+				"results": summary
+			}, indent = "\t"))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,169 @@
+"""Measures the overhead `HTTPJob` adds to every request, before any handler
+runs. Each revision's `src/backend` is staged into a temporary directory and
+timed in its own process, so the working tree can be compared against any
+earlier revision.
+
+```
+python benchmarks/request_parsing.py --revisions HEAD~1 working
+```
+"""
+
+from argparse import ArgumentParser
+from io import BytesIO
+from json import dumps, loads
+from subprocess import PIPE, run
+from timeit import Timer
+from typing import Any, Callable, Dict
+import os
+import shutil
+import sys
+import tempfile
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Headers a browser sends with every request.
+browser_headers = {
+	"HTTP_HOST": "chat.example.com",
+	"HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64; rv:120.0) " +
+		"Gecko/20100101 Firefox/120.0",
+	"HTTP_ACCEPT": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*",
+	"HTTP_ACCEPT_LANGUAGE": "en-US,en;q=0.5",
+	"HTTP_ACCEPT_ENCODING": "gzip, deflate, br",
+	"HTTP_CONNECTION": "keep-alive",
+	"HTTP_REFERER": "https://chat.example.com/",
+	"HTTP_COOKIE": "theme=dark; lang=en",
+	"HTTP_SEC_FETCH_DEST": "empty",
+	"HTTP_SEC_FETCH_MODE": "cors",
+	"HTTP_SEC_FETCH_SITE": "same-origin",
+	"HTTP_CACHE_CONTROL": "no-cache",
+	"HTTP_PRAGMA": "no-cache"
+}
+
+# Run in the staged directory, which prints nanoseconds per request by case.
+worker_script = """
+import sys, json
+sys.path.insert(0, sys.argv[1])
+from request_parsing import measure
+print(json.dumps(measure(int(sys.argv[2]))))
+"""
+
+def environ(uri: str, **headers: str) -> Dict[str, Any]:
+	return {
+		"REQUEST_METHOD": "GET",
+		"REQUEST_URI": uri,
+		"PATH_INFO": uri.partition("?")[0],
+		"QUERY_STRING": uri.partition("?")[2],
+		"SERVER_PROTOCOL": "HTTP/1.1",
+		"wsgi.input": BytesIO(),
+		**browser_headers,
+		**{"HTTP_" + name: value for name, value in headers.items()}
+	}
+
+def measure(number: int) -> Dict[str, float]:
+	"""Times creating a job and reading what the router and handler read from
+	it, for a static file and for a page of messages.
+	"""
+
+	from server_impl import HTTPJob
+
+	def respond(status, headers):
+		pass
+
+	static = environ("/assets/index.js")
+	messages = environ("/api/v1/communities/_/channels/_/messages?limit=50" +
+		"&before=1700000000.5", AUTHORIZATION = "Bearer abcdefghijklmnop")
+
+	def serve_static():
+		job = HTTPJob(static, respond, None)
+		job.path
+		job.method
+		job.headers.get("IF_NONE_MATCH")
+		job.headers.get("RANGE")
+		job.headers.get("ACCEPT_ENCODING", "")
+
+	def serve_messages():
+		job = HTTPJob(messages, respond, None)
+		job.path
+		job.method
+		job.headers.get("AUTHORIZATION")
+		job.headers.get("ACCEPT", "")
+		query = job.query
+		# Earlier revisions parse the query into a list of pairs.
+		get = query.get if hasattr(query, "get") else dict(query).get
+		for name in ("before", "after", "cursor", "polling", "limit"):
+			get(name)
+
+	cases: Dict[str, Callable[[], None]] = {
+		"static": serve_static,
+		"messages": serve_messages
+	}
+	return {
+		name: min(Timer(case).repeat(5, number)) / number * 1e9 \
+			for name, case in cases.items()
+	}
+
+def stage(revision: str, directory: str):
+	"""Lays out `src/backend` of `revision` as `server_impl`, or of the working
+	tree if `revision` is "working".
+	"""
+
+	destination = os.path.join(directory, "server_impl")
+	if revision == "working":
+		shutil.copytree(os.path.join(repository, "src", "backend"), destination,
+			ignore = shutil.ignore_patterns("__pycache__"))
+	else:
+		archive = run(["git", "archive", revision, "src"], cwd = repository,
+			stdout = PIPE, check = True).stdout
+		run(["tar", "-x", "-C", directory], input = archive, check = True)
+		shutil.move(os.path.join(directory, "src", "backend"), destination)
+		for name in ("frontendmap.json", "statuscodes.json"):
+			shutil.move(os.path.join(directory, "src", name), directory)
+		# The static routes of frontendmap.json must exist to be loaded.
+		shutil.move(os.path.join(directory, "src", "html"),
+			os.path.join(directory, "assets"))
+	if not os.path.exists(os.path.join(directory, "assets")):
+		shutil.copytree(os.path.join(repository, "src", "html"),
+			os.path.join(directory, "assets"))
+	for name in ("frontendmap.json", "statuscodes.json"):
+		if not os.path.exists(os.path.join(directory, name)):
+			shutil.copy(os.path.join(repository, "src", name), directory)
+	shutil.copy(os.path.abspath(__file__),
+		os.path.join(directory, "request_parsing.py"))
+
+def run_revision(revision: str, number: int) -> Dict[str, float]:
+	directory = tempfile.mkdtemp(prefix = "chat-bench-")
+	try:
+		stage(revision, directory)
+		env = {
+			**os.environ,
+			"STORAGE": "local",
+			"LOCAL_STORAGE_PATH": os.path.join(directory, "data")
+		}
+		result = run([sys.executable, "-c", worker_script, directory,
+			str(number)], cwd = directory, env = env, stdout = PIPE, check = True)
+		return loads(result.stdout.decode("utf-8").strip().splitlines()[-1])
+	finally:
+		shutil.rmtree(directory, ignore_errors = True)
+
+def main():
+	parser = ArgumentParser(description = "Measures the overhead of HTTPJob.")
+	parser.add_argument("--revisions", nargs = "+", default = ["working"],
+		help = 'git revisions to compare, "working" being the working tree')
+	parser.add_argument("--number", type = int, default = 20000,
+		help = "requests per timing")
+	parser.add_argument("--json", help = "also write the results to this file")
+	args = parser.parse_args()
+
+	results = {revision: run_revision(revision, args.number) \
+		for revision in args.revisions}
+	print(f"{'revision':<16}" + "".join(f"{name + ' ns':>14}" \
+		for name in next(iter(results.values()))))
+	for revision, timings in results.items():
+		print(f"{revision:<16}" + "".join(f"{timing:>14.0f}" \
+			for timing in timings.values()))
+	if args.json is not None:
+		with open(args.json, "w") as file:
+			file.write(dumps(results, indent = "\t"))
+
+if __name__ == "__main__":
+	main()
@@ -1,55 +1,189 @@
 from gevent import monkey; monkey.patch_all()
-from gevent import spawn
+from .lifecycle import startup_phases
+from gevent import Greenlet, GreenletExit, signal_handler, spawn
 from gevent.queue import Queue
 from gevent.pywsgi import WSGIServer, WSGIHandler, Input
 from typing import Any, Callable, Dict, List, Tuple, Union, Optional
-from urllib.parse import parse_qsl, unquote, urlparse
 from json import loads
+from socket import IPPROTO_TCP, TCP_NODELAY
+from signal import SIGINT, SIGTERM
 from os import getenv, path as ospath
+from time import perf_counter, time
+from .request import Headers, MultiDict, split_path
 
 Environ = Dict[str, Any]
 StartResponse = Callable[[str, List[Tuple[str, str]]], Any]
 
+max_body_size = int(getenv("MAX_BODY_SIZE", 64 * 1024))
+startup_wait = float(getenv("STARTUP_WAIT", 30))
+# The server only listens on loopback behind a proxy, which can name the client
+# in a header such as X-Forwarded-For. Only the address the proxy added last is
+# used, since everything before it came from the client.
+client_address_header = getenv("CLIENT_ADDRESS_HEADER")
+client_address_key = None if client_address_header is None else \
+	"HTTP_" + client_address_header.upper().replace("-", "_")
+
 class RequestLinePathHandler(WSGIHandler):
+	def handle(self):
+		# The head and body of a response are sent with separate writes, and
+		# Nagle's algorithm would hold the body back until the client acknowledges
+		# the head, which costs a delayed ACK on every keep-alive request.
+		try:
+			self.socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+		except OSError:
+			pass
+		return super().handle()
+
 	def get_environ(self):
 		return {
 			**super().get_environ(),
 			'REQUEST_URI': self.path,
 		}
 
+	def handle_one_response(self):
+		# A body that is too large is turned away without reading it, which means
+		# the connection can't be used for another request.
+		declared = self.environ.get("CONTENT_LENGTH")
+		if declared is not None and declared.isdigit() and \
+				int(declared) > max_body_size:
+			self.time_start = time()
+			self.close_connection = True
+			self.start_response(HTTPJob.status_codes[413],
+				[("Content-Length", "0"), ("Connection", "close")])
+			self.write(b"")
+			self.time_finish = time()
+			self.log_request()
+			return
+
+		# WebSocket upgrades take over the connection instead of producing a WSGI
+		# response.
+		if self.environ.get("HTTP_UPGRADE", "").lower() != "websocket" or \
+				self.path.split("?", 1)[0] != GATEWAY_PATH:
+			return super().handle_one_response()
+
+		self.time_start = time()
+		self.response_length = 0
+		self.close_connection = True
+		try:
+			self.status = upgrade_gateway(self)
+		finally:
+			self.time_finish = time()
+			# The query may hold a session token, which doesn't belong in the log.
+			self.requestline = f"{self.command} {GATEWAY_PATH} " + \
+				self.request_version
+			self.log_request()
+
+class StatusCodes:
+	"""The status line of every status code, read from `statuscodes.json` the
+	first time one is needed.
+	"""
+
+	def __init__(self, file: str):
+		self.file = file
+		self._lines: Optional[Dict[int, str]] = None
+
+	def _load(self) -> Dict[int, str]:
+		if self._lines is None:
+			with open(self.file, "r") as file:
+				self._lines = {
+					int(code): f"{code} {message}" \
+						for code, message in loads(file.read()).items()
+				}
+		return self._lines
+
+	def get(self, code: int) -> Optional[str]:
+		return self._load().get(code)
+
+	def __getitem__(self, code: int) -> str:
+		return self._load()[code]
+
 class HTTPJob:
 	"""Represents an HTTP request and response pair. The implementation of this
 	means that you don't have to send a response immediately, infact you don't
 	even have to send a response at all.
+
+	The body is streamed to the client as it is written. Without a
+	`Content-Length` header it is sent with chunked transfer encoding, and
+	writing blocks while too many parts are waiting to be sent. Once the client
+	has disconnected `disconnected` is set and writes are ignored.
+
+	The request's `headers`, `path` and `query` are only parsed once they are
+	first used, since many requests never need some of them.
 	"""
 
-	status_codes = {
-		int(code): f"{code} {message}" \
-			for code, message in loads(open(ospath.join(ospath.dirname(__file__),
-				"../statuscodes.json"), "r").read()).items()
-	}
+	__slots__ = ("_request", "_wr_head_fn", "_wr_body_queue", "_headers",
+		"_path", "_query", "head_written", "disconnected", "status_code", "method",
+		"body")
+
+	status_codes = StatusCodes(ospath.join(ospath.dirname(__file__),
+		"../statuscodes.json"))
 
 	def __init__(self, request: Environ, respond: StartResponse, body: Queue):
+		self._request = request
 		self._wr_head_fn = respond
 		self._wr_body_queue = body
+		self._headers: Optional[Headers] = None
+		self._path: Optional[List[str]] = None
+		self._query: Optional[MultiDict] = None
+		self.head_written = False
+		self.disconnected = False
+		self.status_code = 0
+		self.method: str = request["REQUEST_METHOD"]
+		self.body: Input = request["wsgi.input"]
 
-		method = request.get("REQUEST_METHOD")
-		path = request.get("REQUEST_URI")
-		body = request.get("wsgi.input")
-		assert method is not None
-		assert path is not None
-		assert body is not None
-		self.method: str = method
-		self.uri: str = path
-		self.body: Input = body
-		self.headers = {
-			key[5:]: val for key, val in request.items() if key.startswith("HTTP_")
-		}
+	@property
+	def uri(self) -> str:
+		return self._request["REQUEST_URI"]
+
+	@property
+	def remote_address(self) -> Optional[str]:
+		"""The client's address, as told by the proxy in front of the server if
+		`CLIENT_ADDRESS_HEADER` is set.
+		"""
+
+		if client_address_key is not None:
+			forwarded = self._request.get(client_address_key)
+			if forwarded is not None:
+				return forwarded.rpartition(",")[2].strip()
+		return self._request.get("REMOTE_ADDR")
+
+	@property
+	def headers(self) -> Headers:
+		if self._headers is None:
+			self._headers = Headers(self._request)
+		return self._headers
+
+	@property
+	def path(self) -> List[str]:
+		if self._path is None:
+			self._path = split_path(self.uri.partition("?")[0].partition("#")[0])
+		return self._path
+
+	@property
+	def query(self) -> MultiDict:
+		if self._query is None:
+			self._query = MultiDict.parse(
+				self.uri.partition("?")[2].partition("#")[0])
+		return self._query
+
+	def read_body(self, max_size: Optional[int] = None) -> Optional[bytes]:
+		"""Reads the whole body, of at most `max_size` bytes, `MAX_BODY_SIZE` by
+		default. A larger body is rejected with a 413 response, before any of it
+		is read if the request says how long it is, and None is returned.
+		"""
+
+		max_size = max_size if max_size is not None else max_body_size
+		declared = self._request.get("CONTENT_LENGTH")
+		if declared is not None and declared.isdigit() and \
+				int(declared) > max_size:
+			self.close_head(413, {"Content-Length": "0", "Connection": "close"})
+			return None
 
-		url = urlparse(path)
-		self.path = [] if url.path == "/" else \
-			[unquote(path) for path in url.path.split("/")][1:]
-		self.query = parse_qsl(url.query)
+		content = self.body.read(max_size + 1)
+		if len(content) > max_size:
+			self.close_head(413, {"Content-Length": "0", "Connection": "close"})
+			return None
+		return content
 
 	def write_head(self, status: Union[int, str], headers: Dict[str, str] = {}):
 		"""Writes the head of the response. All headers must be supplied in
@@ -63,6 +197,8 @@ class HTTPJob:
 			raise ValueError("Invalid status code.")
 
 		self._wr_head_fn(status_data, header_arr)
+		self.head_written = True
+		self.status_code = int(status_data[:3])
 
 	def close_head(self, status: Union[int, str], headers: Dict[str, str] = {}):
 		"""Writes the head of the response, then ends the request with no content.
@@ -76,6 +212,9 @@ class HTTPJob:
 		any combination of them.
 		"""
 
+		if self.disconnected:
+			return
+
 		data = [
 			(part.encode("utf-8") if isinstance(part, str) else part) \
 				for part in (body if isinstance(body, list) else [body])
@@ -92,7 +231,8 @@ class HTTPJob:
 
 		if body is not None:
 			self.write_body(body)
-		self._wr_body_queue.put(StopIteration)
+		if not self.disconnected:
+			self._wr_body_queue.put(StopIteration)
 
 	def done(self):
 		"""Typically should only be used for debugging. Sends a complete response
@@ -102,18 +242,166 @@ class HTTPJob:
 		self.write_head(204, {})
 		self.close_body()
 
-from .endpoints import handler
+from .endpoints import HEALTH_PATH, add_static_routes, handler, \
+	request_admission
+from .gateway import GATEWAY_PATH, handle_gateway
+from .database import bootstrap_schema, flush_message_writes, open_database, \
+	warm_timelines
+from .storage import storage_class
+from .prefork import Supervisor, drain_timeout
+from .metrics import start_loop_lag_monitor
+from .utilities import dump_json, prepare_static_content
+
+response_queue_size = int(getenv("RESPONSE_QUEUE_SIZE", 64))
+
+class ResponseBody:
+	"""The WSGI response of an `HTTPJob`, handing each part of the body to the
+	server as soon as it is written. If the server stops reading before the body
+	is closed, the client has gone away, so the job is marked as disconnected
+	and its handler greenlet is killed.
+
+	This deliberately has no length, since the server would otherwise try to
+	measure the body before sending any of it.
+	"""
+
+	def __init__(self, job: HTTPJob, queue: Queue, greenlet: Greenlet):
+		self._job = job
+		self._queue = queue
+		self._greenlet = greenlet
+		self._finished = False
+
+	def __iter__(self):
+		return self
+
+	def __next__(self) -> bytes:
+		part = self._queue.get()
+		if part is StopIteration:
+			self._finished = True
+			raise StopIteration
+		return part
+
+	def close(self):
+		if self._finished:
+			return
+		self._job.disconnected = True
+		self._greenlet.kill(block = False)
+		# Unblock the handler if it is waiting for room in the queue.
+		while not self._queue.empty():
+			self._queue.get_nowait()
+
+def unavailable(message: str) -> Tuple[bytes, List[Tuple[str, str]]]:
+	body = f'{{"message":"{message}"}}'.encode("utf-8")
+	return body, [
+		("Content-Type", "application/json; charset=utf-8"),
+		("Content-Length", str(len(body))),
+		("Retry-After", "1")
+	]
+
+overloaded_body, overloaded_headers = \
+	unavailable("The server is overloaded, try again later.")
+starting_body, starting_headers = \
+	unavailable("The server is starting, try again later.")
+
+def run_job(job: HTTPJob):
+	try:
+		handler(job)
+	except GreenletExit:
+		raise
+	except Exception:
+		# Don't leave the client waiting on a response that will never finish.
+		if not job.head_written:
+			job.close_head(500, {"Content-Length": "0"})
+		else:
+			job.close_body()
+		raise
+	finally:
+		request_admission.leave()
 
 def direct_request_handler(request: Environ, respond: StartResponse):
-	body = Queue()
+	# Until startup finishes only health checks are answered right away.
+	if not startup_phases.ready.is_set() and \
+			request["REQUEST_URI"].partition("?")[0] != HEALTH_PATH and \
+			not startup_phases.ready.wait(startup_wait):
+		respond(HTTPJob.status_codes[503], starting_headers)
+		return [starting_body]
+
+	# Waits in the connection's own greenlet, so that a shed request never
+	# costs a greenlet of its own.
+	if not request_admission.enter():
+		respond(HTTPJob.status_codes[503], overloaded_headers)
+		return [overloaded_body]
+
+	body = Queue(response_queue_size)
 	job = HTTPJob(request, respond, body)
-	spawn(handler, job)
-	return list(body)
+	return ResponseBody(job, body, spawn(run_job, job))
+
+def upgrade_gateway(handler: WSGIHandler) -> str:
+	"""Hands a WebSocket upgrade over to the gateway once startup finished and
+	the request was admitted, as `direct_request_handler` does for every other
+	request. Returns the status line that was sent.
+	"""
+
+	if not startup_phases.ready.wait(startup_wait):
+		body, headers = starting_body, starting_headers
+	elif not request_admission.enter():
+		body, headers = overloaded_body, overloaded_headers
+	else:
+		try:
+			return handle_gateway(handler)
+		finally:
+			request_admission.leave()
+
+	status = HTTPJob.status_codes[503]
+	handler.start_response(status, headers + [("Connection", "close")])
+	handler.write(body)
+	return status
+
+def startup():
+	"""Connects to the database and prepares this process' in-memory state for
+	serving, one timed phase at a time. This runs once the server is already
+	accepting connections, and requests other than health checks wait for it.
+	"""
+
+	dev_mode = getenv("DEV_MODE", "").lower() in ("1", "true")
+	with startup_phases.phase("storage"):
+		open_database()
+	with startup_phases.phase("schema"):
+		bootstrap_schema(check_plans = dev_mode)
+	with startup_phases.phase("timelines"):
+		warm_timelines()
+	with startup_phases.phase("static"):
+		add_static_routes()
+		prepare_static_content()
+	start_loop_lag_monitor()
+	startup_phases.finish()
 
 def main():
 	port_env = getenv("PORT")
-	port = port_env if port_env is not None else 8080
+	port = int(port_env) if port_env is not None else 8080
+	workers = int(getenv("WORKERS", 1))
+
+	if workers > 1 and not storage_class().shared:
+		raise ValueError("This storage can only be used by a single worker.")
+	if workers > 1:
+		# Every worker starts up after being forked, since database connections
+		# can't be shared between processes.
+		Supervisor(('127.0.0.1', port), direct_request_handler,
+			RequestLinePathHandler, workers, startup,
+			lambda: flush_message_writes(10),
+			lambda data: dump_json(data, indent=None)).serve_forever()
+		return
 
 	server = WSGIServer(('127.0.0.1', port), direct_request_handler,
 		handler_class=RequestLinePathHandler)
+	# Stop accepting, give open requests some time to finish, and then write
+	# every message that is still waiting, as pre-forked workers do.
+	stop = lambda: spawn(server.stop, drain_timeout)
+	signal_handler(SIGTERM, stop)
+	signal_handler(SIGINT, stop)
+	with startup_phases.phase("bind"):
+		server.start()
+	startup()
 	server.serve_forever()
+	flush_message_writes(10)
+
+startup_phases.record("import", perf_counter() - startup_phases.started)
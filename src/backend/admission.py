@@ -0,0 +1,135 @@
+from gevent.event import Event
+from collections import OrderedDict, deque
+from time import monotonic
+from typing import Deque, Dict, Hashable, List
+from contextlib import contextmanager
+
+class AdmissionQueue:
+	"""Bounds how many requests are handled at once. Requests past `max_active`
+	wait in line for up to `max_wait` seconds, and once `max_queued` are waiting
+	any more are shed, so a burst costs a bounded amount of memory instead of a
+	greenlet per connection.
+
+	Requests that park for a long time, like long polls, can give up their slot
+	while they wait with `parked`.
+	"""
+
+	def __init__(self, max_active: int, max_queued: int, max_wait: float):
+		self.max_active = max_active
+		self.max_queued = max_queued
+		self.max_wait = max_wait
+		self.active = 0
+		self.shed = 0
+		self._waiters: Deque[Event] = deque()
+
+	@property
+	def queued(self) -> int:
+		return len(self._waiters)
+
+	def enter(self) -> bool:
+		"""Takes a slot, waiting in line for one if needed. Returns False if the
+		request was shed instead, in which case `leave` must not be called.
+		"""
+
+		if self.active < self.max_active and len(self._waiters) == 0:
+			self.active += 1
+			return True
+		if len(self._waiters) >= self.max_queued:
+			self.shed += 1
+			return False
+
+		waiter = Event()
+		self._waiters.append(waiter)
+		if waiter.wait(self.max_wait) or waiter.is_set():
+			# The slot was handed over by `leave`.
+			return True
+		self._waiters.remove(waiter)
+		self.shed += 1
+		return False
+
+	def leave(self):
+		if len(self._waiters) > 0:
+			self._waiters.popleft().set()
+		else:
+			self.active -= 1
+
+	@contextmanager
+	def parked(self):
+		"""Gives up the slot for the duration of the block. The slot is taken back
+		afterwards without waiting, since the request is about to finish anyway.
+		"""
+
+		self.leave()
+		try:
+			yield
+		finally:
+			self.active += 1
+
+class ConcurrencyLimit:
+	"""Counts what is in progress per key, like the long polls of each user, and
+	refuses to start more than `max_per_key` of them for a key or `max_total` of
+	them overall.
+	"""
+
+	def __init__(self, max_total: int, max_per_key: int):
+		self.max_total = max_total
+		self.max_per_key = max_per_key
+		self.total = 0
+		self._counts: Dict[Hashable, int] = {}
+
+	@property
+	def full(self) -> bool:
+		return self.total >= self.max_total
+
+	def acquire(self, key: Hashable) -> bool:
+		count = self._counts.get(key, 0)
+		if self.total >= self.max_total or count >= self.max_per_key:
+			return False
+		self._counts[key] = count + 1
+		self.total += 1
+		return True
+
+	def release(self, key: Hashable):
+		count = self._counts[key] - 1
+		if count == 0:
+			del self._counts[key]
+		else:
+			self._counts[key] = count
+		self.total -= 1
+
+class RateLimiter:
+	"""A token bucket per key, holding up to `burst` tokens and refilling at
+	`rate` tokens per second. Buckets are kept in the order they were last used,
+	and only the `max_keys` most recent are remembered, since a forgotten bucket
+	is simply full again.
+	"""
+
+	def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+		self.rate = rate
+		self.burst = burst
+		self.max_keys = max_keys
+		self.limited = 0
+		# The tokens left in each bucket, and when they were counted.
+		self._buckets: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+
+	def take(self, key: Hashable) -> float:
+		"""Takes a token from the bucket of `key`. Returns 0 if there was one, and
+		otherwise how many seconds until there will be.
+		"""
+
+		now = monotonic()
+		bucket = self._buckets.get(key)
+		if bucket is None:
+			bucket = self._buckets[key] = [self.burst, now]
+			if len(self._buckets) > self.max_keys:
+				self._buckets.popitem(last = False)
+		else:
+			self._buckets.move_to_end(key)
+			bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+			bucket[1] = now
+
+		if bucket[0] >= 1:
+			bucket[0] -= 1
+			return 0
+		self.limited += 1
+		return (1 - bucket[0]) / self.rate
@@ -0,0 +1,253 @@
+from gevent.event import AsyncResult
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Type, \
+	TypeVar
+
+T = TypeVar("T")
+
+class CacheEntry:
+	"""A single cached object, along with the last time it was accessed. Entries
+	are stored in access order, so the least recently used entry of an index is
+	always first.
+	"""
+
+	__slots__ = ("value", "accessed")
+
+	def __init__(self, value: Any, accessed: float):
+		self.value = value
+		self.accessed = accessed
+
+class Cache:
+	"""An identity map for database objects. Each class gets its own hash index
+	keyed by the object's unique id, so lookups and updates are O(1). Entries
+	expire `ttl` seconds after they were last accessed, and once the cache holds
+	more than `max_entries` objects the least recently used entry across all
+	indexes is evicted.
+
+	Hit, miss, eviction and expiry counters can be read with `stats`.
+	"""
+
+	def __init__(self, max_entries: int = 10000, ttl: float = 500):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self._indexes: Dict[type, "OrderedDict[Hashable, CacheEntry]"] = {}
+		self._size = 0
+		self._lock = Lock()
+
+	def _index(self, Class: type) -> "OrderedDict[Hashable, CacheEntry]":
+		index = self._indexes.get(Class)
+		if index is None:
+			index = self._indexes[Class] = OrderedDict()
+		return index
+
+	def get(self, Class: Type[Any], id_attr: Hashable) -> Optional[Any]:
+		"""Gets the cached object of type `Class` with the unique id `id_attr`, or
+		None if it isn't cached or has expired. A hit refreshes the entry's access
+		time.
+		"""
+
+		now = monotonic()
+		with self._lock:
+			index = self._index(Class)
+			entry = index.get(id_attr)
+			if entry is None:
+				self.misses += 1
+				return None
+			if now >= entry.accessed + self.ttl:
+				del index[id_attr]
+				self._size -= 1
+				self.expirations += 1
+				self.misses += 1
+				return None
+
+			entry.accessed = now
+			index.move_to_end(id_attr)
+			self.hits += 1
+			return entry.value
+
+	def set(self, Class: Type[Any], id_attr: Hashable, value: Any):
+		"""Places `value` in the cache under `Class` and `id_attr`, replacing the old
+		object if present, then evicts least recently used entries if the cache is
+		over capacity.
+		"""
+
+		now = monotonic()
+		with self._lock:
+			index = self._index(Class)
+			entry = index.get(id_attr)
+			if entry is None:
+				index[id_attr] = CacheEntry(value, now)
+				self._size += 1
+			else:
+				entry.value = value
+				entry.accessed = now
+				index.move_to_end(id_attr)
+
+			while self._size > self.max_entries:
+				self._evict_lru()
+
+	def discard(self, Class: Type[Any], id_attr: Hashable):
+		"""Removes the object of type `Class` with the unique id `id_attr` from the
+		cache, if present.
+		"""
+
+		with self._lock:
+			if self._index(Class).pop(id_attr, None) is not None:
+				self._size -= 1
+
+	def _evict_lru(self):
+		# Every index is in access order, so the globally least recently used entry
+		# is the oldest of the indexes' first entries.
+		oldest: Optional[Tuple[float, "OrderedDict[Hashable, CacheEntry]"]] = None
+		for index in self._indexes.values():
+			if len(index) == 0:
+				continue
+			first = next(iter(index.values()))
+			if oldest is None or first.accessed < oldest[0]:
+				oldest = (first.accessed, index)
+
+		if oldest is not None:
+			oldest[1].popitem(last = False)
+			self._size -= 1
+			self.evictions += 1
+
+	def expire(self):
+		"""Removes every expired entry. Since the indexes are in access order this
+		only touches the entries that are actually removed.
+		"""
+
+		deadline = monotonic() - self.ttl
+		with self._lock:
+			for index in self._indexes.values():
+				while len(index) > 0:
+					id_attr, entry = next(iter(index.items()))
+					if entry.accessed > deadline:
+						break
+					del index[id_attr]
+					self._size -= 1
+					self.expirations += 1
+
+	def clear(self):
+		with self._lock:
+			self._indexes = {}
+			self._size = 0
+
+	def stats(self) -> Dict[str, int]:
+		"""Returns the cache's counters and current size.
+		"""
+
+		return {
+			"entries": self._size,
+			"max_entries": self.max_entries,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"expirations": self.expirations
+		}
+
+	def __len__(self) -> int:
+		return self._size
+
+class NegativeCache:
+	"""Remembers, for `ttl` seconds, ids that were looked up and don't exist, so
+	that asking again doesn't query the database. Once more than `max_entries`
+	are remembered the oldest is forgotten.
+
+	`generation` changes whenever an id is discarded, which lets a lookup that
+	was already running tell that what it found may be out of date.
+	"""
+
+	def __init__(self, max_entries: int = 10000, ttl: float = 5):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.hits = 0
+		self.generation = 0
+		# The time each id was found missing, oldest first.
+		self._missing: "OrderedDict[Hashable, float]" = OrderedDict()
+		self._lock = Lock()
+
+	def __contains__(self, key: Hashable) -> bool:
+		found = self._missing.get(key)
+		if found is None or monotonic() - found >= self.ttl:
+			return False
+		self.hits += 1
+		return True
+
+	def add(self, key: Hashable):
+		with self._lock:
+			self._missing.pop(key, None)
+			self._missing[key] = monotonic()
+			if len(self._missing) > self.max_entries:
+				self._missing.popitem(last = False)
+
+	def discard(self, key: Hashable):
+		with self._lock:
+			self._missing.pop(key, None)
+			self.generation += 1
+
+	def expire(self):
+		deadline = monotonic() - self.ttl
+		with self._lock:
+			while len(self._missing) > 0:
+				key, found = next(iter(self._missing.items()))
+				if found > deadline:
+					break
+				del self._missing[key]
+
+	def __len__(self) -> int:
+		return len(self._missing)
+
+class _Abandoned(Exception):
+	pass
+
+class SingleFlight:
+	"""Coalesces concurrent calls for the same key, so that when many greenlets
+	miss the cache for the same object at once only the first of them queries
+	the database and the rest wait for its result.
+	"""
+
+	def __init__(self):
+		self.shared = 0
+		self._calls: Dict[Hashable, AsyncResult] = {}
+
+	def do(self, key: Hashable, function: Callable[..., T], *args: Any) -> T:
+		"""Calls `function` with `args`, unless a call for `key` is already in
+		progress, in which case its result is returned instead.
+		"""
+
+		while (call := self._calls.get(key)) is not None:
+			self.shared += 1
+			try:
+				return call.get()
+			except _Abandoned:
+				# The greenlet making the call was killed, so take over from it.
+				continue
+
+		call = self._calls[key] = AsyncResult()
+		try:
+			result = function(*args)
+		except Exception as error:
+			call.set_exception(error)
+			raise
+		except BaseException:
+			call.set_exception(_Abandoned())
+			raise
+		else:
+			call.set(result)
+			return result
+		finally:
+			if self._calls.get(key) is call:
+				del self._calls[key]
+
+	def forget(self, key: Hashable):
+		"""Makes the next call for `key` start afresh, rather than wait for the one
+		in progress, whose result may be out of date.
+		"""
+
+		self._calls.pop(key, None)
@@ -1,25 +1,56 @@
 import os
-from pymongo import MongoClient
-from pymongo.database import Database, Collection
-from datetime import datetime, timedelta
 from time import sleep
 from threading import Thread
-from inspect import signature
-from .utilities import ptr
-from typing import Any, Callable, Dict, Tuple, Type, TypeVar, Optional, Union
-
-C = TypeVar("C")
+from .cache import Cache, NegativeCache, SingleFlight
+from .model import Model
+from .timeline import Position, Timeline, position_before
+from .sessions import SessionStore
+from .serialization import fragments
+from .prefork import broadcast, on_peer_event
+from .writebehind import WriteBehind
+from .metrics import instrument, metrics
+from .storage import Document, Storage, open_storage
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Type, TypeVar, \
+	Optional, Union
+
+C = TypeVar("C", bound = Model)
 T = TypeVar("T")
 
-_client: Database = MongoClient(os.getenv("MONGO_DB_CONNECT"))["project-dark"]
-
-_db_cache: ptr[Dict[object, datetime]] = ptr(dict())
-
-class User:
+# Opened by `open_database`, along with everything else that needs it.
+_storage: Storage = None # type: ignore
+_sessions: SessionStore = None # type: ignore
+_storage_seconds = metrics.histogram("storage_operation_duration_seconds",
+	"How long each operation on the storage took.", ("operation",))
+
+_db_cache = Cache(int(os.getenv("DB_CACHE_MAX_ENTRIES", 10000)),
+	float(os.getenv("DB_CACHE_TTL", 500)))
+
+# Ids that were looked up and don't exist, and lookups that are in progress.
+_missing = NegativeCache(int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", 10000)),
+	float(os.getenv("NEGATIVE_CACHE_TTL", 5)))
+_lookups = SingleFlight()
+
+# Every channel gets its own timeline, created when the channel is first used.
+_timeline_capacity = int(os.getenv("TIMELINE_CAPACITY", 5000))
+_timelines: Dict[Tuple[str, str], Timeline] = {}
+# Timeline versions only mean something within one process, so they are
+# qualified by this to tell them apart from other workers' and earlier runs'.
+# Made by `open_database`, which runs after workers are forked.
+_process_epoch = ""
+
+# "sync" writes each message before returning, "behind" returns right away and
+# writes messages in batches, and "batched" also writes in batches but waits
+# for the message's batch to be written.
+_message_write_mode = os.getenv("MESSAGE_WRITE_MODE", "sync")
+_message_writes: Optional[WriteBehind] = None
+
+class User(Model):
 	"""Represents a user, piping hot from the database. Users' unique id is the
 	name property.
 	"""
 
+	__slots__ = ("name", "password", "about")
+
 	def __init__(self, name: str, password: str, about: Optional[str] = None):
 		self.name = name
 		self.password = password
@@ -30,15 +61,29 @@ class User:
 			"name": self.name
 		}
 
-class Message:
+class Message(Model):
 	"""Represents a message, piping hot from the database. Messages' unique id is
-	the timestamp property.
+	the key property, made of the community, channel and position. The position
+	is the timestamp, with the author as a tiebreaker.
 	"""
 
-	def __init__(self, timestamp: float, author: Union[User, str], content: str):
+	__slots__ = ("timestamp", "author", "content", "community", "channel")
+
+	def __init__(self, timestamp: float, author: Union[User, str], content: str,
+			community: str = "_", channel: str = "_"):
 		self.timestamp = timestamp
 		self.author = author.name if isinstance(author, User) else author
 		self.content = content
+		self.community = community
+		self.channel = channel
+
+	@property
+	def position(self) -> Position:
+		return (self.timestamp, self.author)
+
+	@property
+	def key(self) -> Tuple[str, str, float, str]:
+		return (self.community, self.channel, self.timestamp, self.author)
 
 	def __to_json__(self):
 		return {
@@ -47,140 +92,449 @@ class Message:
 			"content": self.content
 		}
 
-class Invite:
+class Channel(Model):
+	"""Represents a channel of a community, piping hot from the database.
+	Channels' unique id is the key property, made of the community and channel.
+	"""
+
+	__slots__ = ("community", "channel", "about")
+
+	def __init__(self, community: str, channel: str, about: Optional[str] = None):
+		self.community = community
+		self.channel = channel
+		self.about = about
+
+	@property
+	def key(self) -> Tuple[str, str]:
+		return (self.community, self.channel)
+
+	def __to_json__(self):
+		return {
+			"community": self.community,
+			"channel": self.channel,
+			"about": self.about
+		}
+
+class Invite(Model):
+	__slots__ = ("code", "inviter", "accepter")
+
 	def __init__(self, code: str, inviter: Optional[Union[User, str]],
 			accepter: Optional[Union[User, str]]):
 		self.code = code
 		self.inviter = inviter.name if isinstance(inviter, User) else inviter
 		self.accepter = accepter.name if isinstance(accepter, User) else accepter
 
-def _create_simple_db_cache_getter(cache: ptr[Dict[Any, datetime]],
-		collection: Collection, id_name: str, id_type: Type[T], Class: Type[C]):
-	"""Creates a getter function for a database collection that has only one
-	unique property to worry about. The getter function returned will
-	automatically query the `cache` first, and if required set the newly made
-	object in the `cache`. The returned object type is supplied as `Class`, and
-	the unique id is supplied as `id_name` and it's type as `id_type`. `id_type`
-	is only used for type hinting.
+def _forget_missing(Class: type, id_attr: Any):
+	"""Forgets that the object may not exist, including in lookups that are
+	still in progress.
+	"""
+
+	_missing.discard((Class, id_attr))
+	_lookups.forget((Class, id_attr))
+
+def _create_simple_db_cache_getter(cache: Cache,
+		load: Callable[[T], Optional[Document]], id_type: Type[T],
+		Class: Type[C]):
+	"""Creates a getter function for data that has only one unique property to
+	worry about. The getter function returned will automatically query the
+	`cache` first, and if required `load` the object's document from the storage
+	and set the newly made object in the `cache`. The returned object type is
+	supplied as `Class`, and the unique id's type as `id_type`. `id_type` is only
+	used for type hinting.
+
+	Ids that don't exist are remembered for a while too, and concurrent misses
+	for the same id share a single query.
 	"""
 
-	def create(raw_obj: Dict[str, Any]):
-		class_params = signature(Class).parameters
-		args = {key: val for key, val in raw_obj.items() if key in class_params}
-		return Class(**args)
+	def query(id_attr: T) -> Optional[C]:
+		generation = _missing.generation
+		raw_obj = load(id_attr)
+		obj = Class.from_document(raw_obj) if raw_obj is not None else None
 
-	def db_getter(id_attr: T) -> Optional[C]:
-		nonlocal cache
+		# Something was stored while querying, so the result may be out of date.
+		if _missing.generation != generation:
+			return obj
+		if obj is None:
+			_missing.add((Class, id_attr))
+		else:
+			cache.set(Class, id_attr, obj)
+		return obj
 
-		cached_obj = next((obj for obj, time in cache.value.items() \
-			if isinstance(obj, Class) and getattr(obj, id_name) == id_attr), None)
-		
+	def db_getter(id_attr: T) -> Optional[C]:
+		cached_obj = cache.get(Class, id_attr)
 		if cached_obj is not None:
-			# Update the cache with the access time.
-			cache.value = {
-				**cache.value,
-				cached_obj: datetime.now()
-			}
 			return cached_obj
-		else:
-			# Query the data base since this query hasn't been cached.
-			raw_obj = collection.find_one({id_name: id_attr})
-			if raw_obj is None:
-				return None
-
-			obj = create(raw_obj)
-			# Update cache with the object.
-			cache.value = {
-				**cache.value,
-				obj: datetime.now()
-			}
-			return obj
+		if (Class, id_attr) in _missing:
+			return None
+
+		# Query the storage since this query hasn't been cached.
+		return _lookups.do((Class, id_attr), query, id_attr)
 	return db_getter
 
-def _create_simple_db_cache_setter(cache: ptr[Dict[Any, datetime]],
-		collection: Collection, id_name: str, Class: Type[C]):
-	"""Creates a setter function for a database collection that has only one
-	unique property to worry about. The setter function returned will
-	automatically place the new value in the `cache`. The accepted object type is
-	supplied as `Class`, and the unique id is supplied as `id_name`.
+def _create_simple_db_cache_setter(cache: Cache,
+		store: Callable[[Document], None], id_name: str, Class: Type[C]):
+	"""Creates a setter function for data that has only one unique property to
+	worry about. The setter function returned will `store` the object's document
+	and automatically place the new value in the `cache`. The accepted object
+	type is supplied as `Class`, and the unique id is supplied as `id_name`.
 	"""
 
 	def db_setter(new_obj: C):
-		nonlocal cache
-
 		id_attr = getattr(new_obj, id_name)
-		collection.replace_one({id_name: id_attr}, vars(new_obj), True)
+		store(new_obj.to_document())
 
 		# Update cache with the new object, replacing the old one if present.
-		cache.value = {
-			**{
-				key: val for key, val in cache.value.items() \
-					if type(val) != Class or getattr(key, id_name) != id_attr
-			},
-			new_obj: datetime.now()
-		}
+		_forget_missing(Class, id_attr)
+		cache.set(Class, id_attr, new_obj)
+		fragments.invalidate(new_obj)
 	return db_setter
 
-def _create_simple_db_cache_getter_setter(cache: ptr[Dict[Any, datetime]],
-		collection: Collection, id_name: str, id_type: Type[T], Class: Type[C]) -> \
-		Tuple[Callable[[T], Optional[C]], Callable[[C], None]]:
+def _create_simple_db_cache_getter_setter(cache: Cache,
+		load: Callable[[T], Optional[Document]],
+		store: Callable[[Document], None], id_name: str, id_type: Type[T],
+		Class: Type[C]) -> Tuple[Callable[[T], Optional[C]], Callable[[C], None]]:
 	"""Returns a getter setter tuple. Read `_create_simple_db_cache_getter` and
 	`_create_simple_db_cache_setter`'s docs.
 	"""
 
 	return (
-		_create_simple_db_cache_getter(cache, collection, id_name, id_type, Class),
-		_create_simple_db_cache_setter(cache, collection, id_name, Class)
+		_create_simple_db_cache_getter(cache, load, id_type, Class),
+		_create_simple_db_cache_setter(cache, store, id_name, Class)
 	)
 
-def _db_cache_mngmnt_func(cache: ptr[Dict[object, datetime]], seconds: int):
-	delta = timedelta(0, seconds)
+def _db_cache_mngmnt_func(caches: List[Any], seconds: int):
 	while True:
-		now = datetime.now()
-		global _db_cache
-		cache.value = {
-			obj: time for obj, time in cache.value.items() \
-				if now < time + delta
-		}
-		sleep(30)
+		for cache in caches:
+			cache.expire()
+		sleep(seconds)
+
+def get_cache_stats():
+	"""Returns the hit, miss, eviction and expiry counters of the database cache.
+	"""
+
+	return _db_cache.stats()
 
 # Getters and setters for data with one ID...
 
-get_user_by_name, set_user = _create_simple_db_cache_getter_setter(_db_cache, _client.users, "name", str, User)
-get_message_by_timestamp, set_message = _create_simple_db_cache_getter_setter(_db_cache, _client.messages, "timestamp", float, Message)
+fragments.register(User, "name")
+fragments.register(Message, "key")
+fragments.register(Channel, "key")
+
+get_user_by_name, _set_user = _create_simple_db_cache_getter_setter(_db_cache, lambda name: _storage.get_user(name), lambda document: _storage.put_user(document), "name", str, User)
 
 # Advanced getters and setters...
 
-# TODO: Use cache here!
-def get_messages_by_timestamp(timestamp: float, before: bool, limit: int):
-	collection: Collection = _client.messages
+def get_message(community: str, channel: str, timestamp: float,
+		author: str) -> Optional[Message]:
+	cached_message = _db_cache.get(Message,
+		(community, channel, timestamp, author))
+	if cached_message is not None:
+		return cached_message
 
-	aggregation = [
-		{"$match": {"timestamp": {"$lt" if before else "$gt": timestamp}}},
-		{"$sort": {"timestamp": -1 if before else 1}},
-		{"$limit": limit}
-	]
+	raw_message = _storage.get_message(community, channel, timestamp, author)
+	if raw_message is None:
+		return None
+
+	message = Message.from_document(raw_message)
+	_db_cache.set(Message, message.key, message)
+	return message
+
+def _set_message(new_message: Message):
+	_storage.put_message(new_message.to_document())
+
+	_db_cache.set(Message, new_message.key, new_message)
+	fragments.invalidate(new_message)
+
+def get_channel(community: str, channel: str) -> Optional[Channel]:
+	"""Gets a channel's metadata, which is kept in the cache since every request
+	to a channel looks it up.
+	"""
+
+	cached_channel = _db_cache.get(Channel, (community, channel))
+	if cached_channel is not None:
+		return cached_channel
+
+	raw_channel = _storage.get_channel(community, channel)
+	if raw_channel is None:
+		return None
+
+	channel_obj = Channel.from_document(raw_channel)
+	_db_cache.set(Channel, channel_obj.key, channel_obj)
+	return channel_obj
+
+def set_channel(new_channel: Channel):
+	_storage.put_channel(new_channel.to_document())
+
+	_db_cache.set(Channel, new_channel.key, new_channel)
+	fragments.invalidate(new_channel)
+	broadcast("channel_changed", list(new_channel.key))
+
+@on_peer_event("channel_changed")
+def _on_peer_channel_changed(key: List[str]):
+	_db_cache.discard(Channel, tuple(key))
+	fragments.discard(Channel, tuple(key))
+
+def set_user(new_user: User):
+	_set_user(new_user)
+	_sessions.update_user(new_user)
+	broadcast("user_changed", new_user.name)
 
-	raw_messages = collection.aggregate(aggregation)
+@on_peer_event("user_changed")
+def _on_peer_user_changed(name: str):
+	_forget_missing(User, name)
+	_db_cache.discard(User, name)
+	fragments.discard(User, name)
+
+def create_session(user: User):
+	"""Creates a session for `user`, returning the session's token and the
+	timestamp it expires at.
+	"""
+
+	return _sessions.create(user)
+
+def get_user_by_session(token: str) -> Optional[User]:
+	return _sessions.resolve(token)
+
+def delete_session(token: str):
+	_sessions.revoke(token)
+	broadcast("session_revoked", token)
+
+@on_peer_event("session_revoked")
+def _on_peer_session_revoked(token: str):
+	_sessions.forget(token)
+
+def get_users_by_names(names: Iterable[str]) -> List[User]:
+	"""Gets every user named in `names` that exists, in the order they are first
+	named. Cached users are used as is, and all of the others are fetched with a
+	single query.
+	"""
+
+	users: Dict[str, Optional[User]] = {
+		name: _db_cache.get(User, name) for name in dict.fromkeys(names)
+	}
+	missing = [name for name, user in users.items() if user is None]
+
+	if len(missing) > 0:
+		for raw_user in _storage.get_users(missing):
+			user = User.from_document(raw_user)
+			_db_cache.set(User, user.name, user)
+			users[user.name] = user
+
+	return [user for user in users.values() if user is not None]
+
+def set_message(new_message: Message):
+	"""Stores a new message. Unless `MESSAGE_WRITE_MODE` is "sync", the message
+	is written to the database with the next batch. In "behind" mode it is made
+	visible to this process immediately, and in "batched" mode once its batch
+	was written, so a message that failed to be written is never served.
+	"""
+
+	if _message_writes is None:
+		_set_message(new_message)
+		_get_timeline(new_message.community, new_message.channel) \
+			.insert(new_message)
+		return
+
+	written = _message_writes.submit(new_message.to_document())
+	if _message_write_mode == "batched":
+		written.get()
+	cache_message(new_message)
+	fragments.invalidate(new_message)
+
+def flush_message_writes(timeout: Optional[float] = None):
+	"""Waits for every message that is waiting to be written in the background.
+	"""
+
+	if _message_writes is not None:
+		_message_writes.flush(timeout)
+
+def cache_message(message: Message):
+	"""Makes a message that was already stored by someone else, such as another
+	worker, visible to this process without writing it again.
+	"""
+
+	_db_cache.set(Message, message.key, message)
+	_get_timeline(message.community, message.channel).insert(message)
+
+def _get_timeline(community: str, channel: str) -> Timeline:
+	"""Gets a channel's timeline, creating and warming it if this is the first
+	time the channel is used. Messages inserted while it warms are kept.
+	"""
+
+	key = (community, channel)
+	timeline = _timelines.get(key)
+	if timeline is None:
+		timeline = _timelines[key] = Timeline(_timeline_capacity)
+		try:
+			raw_messages = _storage.get_messages(community, channel,
+				position_before(float("inf")), True, timeline.capacity)
+			timeline.warm(Message.from_document(raw_message,
+				community = community, channel = channel) \
+					for raw_message in raw_messages)
+		except BaseException:
+			# Let the next caller try again instead of keeping a cold timeline.
+			if _timelines.get(key) is timeline:
+				del _timelines[key]
+			raise
+	return timeline
+
+def get_messages(community: str, channel: str, position: Position,
+		before: bool, limit: int) -> List[Message]:
+	"""Gets up to `limit` messages of a channel before or after `position`, newest
+	first when going `before` and oldest first otherwise. Recent messages are
+	served from the channel's in-memory timeline, and the storage is only
+	queried for ranges older than it.
+	"""
+
+	messages = _get_timeline(community, channel).query(position, before, limit)
+	if messages is not None:
+		return messages
+
+	raw_messages = _storage.get_messages(community, channel, position, before,
+		limit)
 	return [
-		Message(**{key: val for key, val in raw_message.items() if key != "_id"}) \
-			for raw_message in raw_messages
+		Message.from_document(raw_message, community = community,
+			channel = channel) for raw_message in raw_messages
 	]
 
-# TODO: Use cache here!
-def get_invite_by_code(code: str):
-	raw_obj = _client.invites.find_one({"code": code, "accepter": None})
+def get_channel_version(community: str, channel: str) -> \
+		Tuple[str, Optional[Position]]:
+	"""Gets a tag that changes whenever a message of the channel is stored in
+	this process, along with the position of the channel's newest message. Both
+	are read from the channel's timeline without querying the storage.
+	"""
+
+	timeline = _get_timeline(community, channel)
+	return f"{_process_epoch}.{timeline.version}", timeline.latest
+
+def warm_timelines():
+	"""Caches every channel's metadata, and fills each channel's in-memory
+	timeline with its newest messages.
+	"""
+
+	for raw_channel in _storage.get_channels():
+		channel = Channel.from_document(raw_channel)
+		_db_cache.set(Channel, channel.key, channel)
+		_get_timeline(channel.community, channel.channel)
+
+def open_database():
+	"""Opens the storage and starts the work done in the background, such as
+	expiring caches and writing messages behind. Opening again does nothing.
+	Until this is called nothing can be stored or loaded, which lets the server
+	start serving, and fork its workers, before connecting to the database.
+	"""
+
+	global _storage, _sessions, _message_writes, _process_epoch
+
+	if _storage is not None:
+		return
+	_process_epoch = os.urandom(6).hex()
+	storage = open_storage()
+	# Timed before anything holds on to the storage's methods.
+	instrument(storage, _storage_seconds, [
+		name for name, value in vars(Storage).items() \
+			if callable(value) and not name.startswith("_") and \
+				name not in ("bootstrap", "close")
+	])
+	_storage = storage
+	_sessions = SessionStore(_storage, get_user_by_name,
+		float(os.getenv("SESSION_TTL", 30 * 24 * 60 * 60)),
+		float(os.getenv("UNKNOWN_SESSION_TTL", 60)),
+		int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", 10000)))
+
+	if _message_write_mode != "sync":
+		_message_writes = WriteBehind(_storage.insert_messages,
+			int(os.getenv("MESSAGE_WRITE_BATCH", 100)),
+			float(os.getenv("MESSAGE_WRITE_DELAY", 0.05)),
+			int(os.getenv("MESSAGE_WRITE_QUEUE", 10000)),
+			int(os.getenv("MESSAGE_WRITE_RETRIES", 5)))
+		_message_writes.start()
+
+	Thread(target = _db_cache_mngmnt_func,
+		args = [[_db_cache, _missing, _sessions, _storage], 30],
+		daemon = True).start()
+
+def get_storage() -> Storage:
+	return _storage
+
+def bootstrap_schema(check_plans: bool = False):
+	"""Prepares the storage, such as creating the indexes the queries here rely
+	on, and if `check_plans` is set warns about any query that will be slow.
+	"""
+
+	_storage.bootstrap(check_plans)
+
+def get_timeline_stats():
+	"""Returns the combined size and hit rate of every channel's in-memory
+	timeline.
+	"""
+
+	stats = [timeline.stats() for timeline in list(_timelines.values())]
+	hits = sum(timeline_stats["hits"] for timeline_stats in stats)
+	misses = sum(timeline_stats["misses"] for timeline_stats in stats)
+	return {
+		"channels": len(stats),
+		"entries": sum(timeline_stats["entries"] for timeline_stats in stats),
+		"capacity": _timeline_capacity,
+		"hits": hits,
+		"misses": misses,
+		"hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0
+	}
+
+def _cache_stats(name: str) -> Callable[[], Dict[Tuple[str, ...], float]]:
+	def collect():
+		return {
+			("database",): get_cache_stats()[name],
+			("fragments",): fragments.stats()[name],
+			("timelines",): get_timeline_stats()[name]
+		}
+	return collect
+
+metrics.gauge("cache_hits_total", "Lookups answered from memory, by cache.",
+	_cache_stats("hits"), ("cache",), "counter")
+metrics.gauge("cache_misses_total", "Lookups that missed memory, by cache.",
+	_cache_stats("misses"), ("cache",), "counter")
+metrics.gauge("cache_entries", "Entries held in memory, by cache.",
+	_cache_stats("entries"), ("cache",))
+metrics.gauge("missing_cache_hits_total", "Lookups answered by remembering " +
+	"that the id doesn't exist.", lambda: _missing.hits, kind = "counter")
+metrics.gauge("missing_cache_entries", "Ids remembered not to exist.",
+	lambda: len(_missing))
+metrics.gauge("message_write_retries_total", "Retries of messages written " +
+	"in the background that failed.", lambda: _message_writes.retries \
+		if _message_writes is not None else 0, kind = "counter")
+metrics.gauge("message_writes_failed_total", "Messages written in the " +
+	"background that were given up on, which are lost.",
+	lambda: _message_writes.failed if _message_writes is not None else 0,
+	kind = "counter")
+metrics.gauge("coalesced_lookups_total", "Lookups that waited for the same " +
+	"lookup already in progress instead of querying.", lambda: _lookups.shared,
+	kind = "counter")
+
+def _query_invite(code: str) -> Optional[Invite]:
+	generation = _missing.generation
+	raw_obj = _storage.get_open_invite(code)
 	if raw_obj is None:
+		if _missing.generation == generation:
+			_missing.add((Invite, code))
 		return None
 
-	return Invite(raw_obj.get("code"), raw_obj.get("inviter"),
-		raw_obj.get("accepter"))
+	return Invite.from_document(raw_obj)
+
+def get_invite_by_code(code: str):
+	"""Gets the open invite with `code`. Open invites aren't cached, since
+	accepting one has to see the database, but codes that aren't open are.
+	"""
+
+	if (Invite, code) in _missing:
+		return None
+	return _lookups.do((Invite, code), _query_invite, code)
 
-# TODO: Use cache here!
 def set_invite_by_code(code: str, new_invite: Invite):
-	_client.invites.replace_one({"code": code, "accepter": None},
-		vars(new_invite))
+	_storage.put_invite(code, new_invite.to_document())
+	_forget_missing(Invite, code)
+	broadcast("invite_changed", code)
 
-_db_cache_mngmnt = Thread(target = _db_cache_mngmnt_func,
-	args = [_db_cache, 500], daemon = True)
-_db_cache_mngmnt.start()
+@on_peer_event("invite_changed")
+def _on_peer_invite_changed(code: str):
+	_forget_missing(Invite, code)
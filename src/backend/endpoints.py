@@ -1,22 +1,80 @@
 from urllib.parse import parse_qsl, urlparse, unquote
-from gevent.event import Event
-from . import HTTPJob
-from .utilities import JSONDecodeError, load_json, dump_json, static_routes, \
-	generate_endpoint
-from .database import Invite, Message, User, get_invite_by_code, \
-	get_messages_by_timestamp, get_user_by_name, set_invite_by_code, \
-	set_message, set_user
+from . import HTTPJob, client_address_key
+from .hub import HubItem, MessageHub, render_items
+from .serialization import decode_cursor, encode_cursor, fragments, \
+	render_cursors, render_page
+from .timeline import Position, position_after, position_before
+from .prefork import broadcast, on_peer_event
+from .utilities import HTTPHeadJob, JSONDecodeError, Router, load_json, \
+	dump_json, matches_etag, static_routes, generate_endpoint
+from .metrics import metrics
+from .lifecycle import startup_phases
+from .admission import AdmissionQueue, ConcurrencyLimit, RateLimiter
+from .database import Invite, Message, User, cache_message, create_session, \
+	delete_session, get_channel, get_channel_version, get_invite_by_code, \
+	get_messages, get_user_by_name, get_user_by_session, get_users_by_names, \
+	set_invite_by_code, set_message, set_user
 from typing import Any, Dict, Callable, Union, List, Optional
 from datetime import datetime as DateTime
 from base64 import b64decode
 from re import compile as regex_compile
-from os import path
+from os import getenv, path
+from time import monotonic, perf_counter
+from hmac import compare_digest
+from hashlib import sha1
+from math import ceil, isfinite
 
 auth_regex = regex_compile(r"^(?:(\w+) )?(.*)$")
 token_regex = regex_compile(r"^(\w+):(.*)$")
 username_regex = regex_compile(r"[a-z_]{2,32}")
 
-mut_message_event = Event()
+message_hub = MessageHub()
+
+max_event_streams = int(getenv("MAX_EVENT_STREAMS", 1000))
+event_stream_count = 0
+event_stream_heartbeat = 15
+event_stream_lifetime = 30 * 60
+
+request_admission = AdmissionQueue(int(getenv("MAX_ACTIVE_REQUESTS", 1000)),
+	int(getenv("MAX_QUEUED_REQUESTS", 1000)),
+	float(getenv("MAX_REQUEST_WAIT", 5)))
+long_polls = ConcurrencyLimit(int(getenv("MAX_LONG_POLLS", 5000)),
+	int(getenv("MAX_LONG_POLLS_PER_USER", 4)))
+message_limits = RateLimiter(float(getenv("MESSAGE_RATE", 5)),
+	float(getenv("MESSAGE_BURST", 20)))
+# Signups have no user yet, so they are limited by the client's address. Unless
+# CLIENT_ADDRESS_HEADER is set that is the proxy's, shared by every client, so
+# signups are only limited once it is.
+signup_limits = RateLimiter(float(getenv("SIGNUP_RATE", 0.1)),
+	float(getenv("SIGNUP_BURST", 5)))
+
+HEALTH_PATH = "/api/v1/health"
+metrics_token = getenv("METRICS_TOKEN")
+metric_methods = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+request_count = metrics.counter("http_requests_total",
+	"Requests answered, by route, method and status.",
+	("route", "method", "status"))
+request_duration = metrics.histogram("http_request_duration_seconds",
+	"How long requests took to answer, by route and method.",
+	("route", "method"))
+metrics.gauge("long_polls_active", "Requests waiting for new messages.",
+	lambda: long_polls.total)
+metrics.gauge("requests_active", "Requests being handled, not counting " +
+	"parked long polls and event streams.", lambda: request_admission.active)
+metrics.gauge("requests_queued", "Requests waiting to be handled.",
+	lambda: request_admission.queued)
+metrics.gauge("requests_shed_total", "Requests turned away while overloaded.",
+	lambda: request_admission.shed, kind = "counter")
+metrics.gauge("rate_limited_total", "Requests refused by a rate limit.",
+	lambda: {
+		("messages",): message_limits.limited,
+		("signups",): signup_limits.limited
+	}, ("limit",), "counter")
+metrics.gauge("event_streams_active", "Open streams of server-sent events.",
+	lambda: event_stream_count)
+metrics.gauge("hub_subscriptions", "Subscriptions to new messages, of long " +
+	"polls, event streams and WebSocket clients.",
+	lambda: message_hub.subscriber_count())
 
 def respond_error(job: HTTPJob, message: str, code: Union[str, int] = 400):
 	content = f'{{"message":"{message}"}}'.encode("utf-8")
@@ -28,8 +86,22 @@ def respond_error(job: HTTPJob, message: str, code: Union[str, int] = 400):
 	job.write_head(code, headers)
 	job.close_body(content)
 
+def respond_retry(job: HTTPJob, message: str, retry_after: float,
+		code: Union[str, int] = 429):
+	"""Responds with an error that goes away after `retry_after` seconds.
+	"""
+
+	content = f'{{"message":"{message}"}}'.encode("utf-8")
+	job.write_head(code, {
+		"Content-Type": "application/json; charset=utf-8",
+		"Content-Length": str(len(content)),
+		"Retry-After": str(max(ceil(retry_after), 1))
+	})
+	job.close_body(content)
+
 def get_authorized_user(auth_or_rq: Union[HTTPJob, Optional[str]]):
-	"""Gets the authorized user via the request's authorization header. If for any
+	"""Gets the authorized user via the request's authorization header, which may
+	either be Basic credentials or a Bearer session token. If for any
 	reason the authorization fails, this method automatically sends a response and
 	returns nothing, allowing for a very easy implementation as shown below.
 
@@ -60,7 +132,12 @@ def get_authorized_user(auth_or_rq: Union[HTTPJob, Optional[str]]):
 
 	auth_type = auth_match[1]
 	encoded_token = auth_match[2]
-	if auth_type != "" and auth_type.lower() != "basic":
+	if auth_type is not None and auth_type.lower() == "bearer":
+		user = get_user_by_session(encoded_token)
+		if user is None:
+			return respond("Bad authorization token.", 401)
+		return user
+	if auth_type is not None and auth_type.lower() != "basic":
 		return respond("Unknown authorization type.")
 
 	token = b64decode(encoded_token).decode("utf-8")
@@ -89,9 +166,20 @@ def requires_authorization(function: Callable[..., None]):
 		function(job, authed_user, *args, **kwargs)
 	return on_request
 
+def messages_etag(community: str, channel: str, query: str, limit: int) -> str:
+	"""The entity tag of a page of messages, from the timestamp of the channel's
+	newest message and its version, which changes with every message stored, so
+	it can be worked out without querying any messages. `query` is the page's
+	cursor, or "latest" for the newest messages.
+	"""
+
+	version, latest = get_channel_version(community, channel)
+	digest = sha1(f"{version}\n{query}\n{limit}".encode("utf-8")).hexdigest()
+	return f'"{latest[0] if latest is not None else 0}-{digest[:20]}"'
+
 @requires_authorization
 def on_get_me_request(job: HTTPJob, authed_user: User):
-	content = dump_json(authed_user, indent=None)
+	content = fragments.fragment(authed_user)
 	job.write_head(200, {
 		"Content-Type": "application/json; charset=utf-8",
 		"Content-Length": str(len(content))
@@ -99,7 +187,8 @@ def on_get_me_request(job: HTTPJob, authed_user: User):
 	job.close_body(content)
 
 def on_post_me_request(job: HTTPJob):
-	body = job.body.read()
+	if (body := job.read_body()) is None:
+		return
 	json_body: Dict[str, Any]
 	try:
 		json_body = load_json(body)
@@ -130,13 +219,19 @@ def on_post_me_request(job: HTTPJob):
 		if invite_object is None:
 			return respond_error(job, "Invalid invite.")
 
+		# Only signups that would succeed count, so bad requests can't use up the
+		# client's budget.
+		if client_address_key is not None and \
+				(wait := signup_limits.take(job.remote_address)) > 0:
+			return respond_retry(job, "Too many signups.", wait)
+
 		new_user = User(name, password)
 		new_invite_object = Invite(invite, invite_object.inviter, new_user)
 
 		set_user(new_user)
 		set_invite_by_code(invite, new_invite_object)
 
-		body = dump_json(new_user, indent=None)
+		body = fragments.fragment(new_user)
 
 		job.write_head(200, {
 			"Content-Type": "application/json; charset=utf-8",
@@ -144,89 +239,280 @@ def on_post_me_request(job: HTTPJob):
 		})
 		job.close_body(body)
 
+@requires_authorization
+def on_post_sessions_request(job: HTTPJob, authed_user: User):
+	token, expires = create_session(authed_user)
+	content = dump_json({"token": token, "expires": expires}, indent=None)
+	job.write_head(200, {
+		"Content-Type": "application/json; charset=utf-8",
+		"Content-Length": str(len(content))
+	})
+	job.close_body(content)
+
+def on_delete_sessions_request(job: HTTPJob):
+	auth_match = auth_regex.match(job.headers.get("AUTHORIZATION", ""))
+	if auth_match is None or auth_match[1] is None or \
+			auth_match[1].lower() != "bearer":
+		return respond_error(job, "Expected a bearer token.", 401)
+
+	delete_session(auth_match[2])
+	job.close_head(204)
+
+def parse_timestamp(raw: Optional[str]) -> Optional[float]:
+	"""Parses a timestamp query paramater, which may be fractional. Returns -1 if
+	it isn't a finite positive number.
+	"""
+
+	if raw is None:
+		return None
+	try:
+		timestamp = float(raw)
+	except ValueError:
+		return -1
+	return timestamp if isfinite(timestamp) and timestamp >= 0 else -1
+
+def page_cursors(messages: List[Any], position: Position, before: bool,
+		limit: int) -> bytes:
+	"""Renders the cursors of a page of `messages` fetched from `position`.
+	`next` continues in the same direction, and is null once paging before runs
+	out of messages. `prev` goes back the other way from the first message.
+	"""
+
+	if before and len(messages) < limit:
+		next_cursor = None
+	else:
+		next_cursor = encode_cursor(messages[-1].position if len(messages) > 0 \
+			else position, before)
+	prev_cursor = encode_cursor(messages[0].position if len(messages) > 0 \
+		else position, not before)
+	return render_cursors(next_cursor, prev_cursor)
+
 @requires_authorization
 def on_get_messages_request(job: HTTPJob, authed_user: User, community: str,
 		channel: str):
-	if community != "_" or channel != "_":
+	if get_channel(community, channel) is None:
 		job.write_head(404, {})
 		job.close_body()
 		return
 
-	query = {key: val for key, val in job.query}
+	if "text/event-stream" in job.headers.get("ACCEPT", ""):
+		return stream_messages(job, community, channel)
+
+	query = job.query
 	before_raw = query.get("before")
 	after_raw = query.get("after")
+	cursor_raw = query.get("cursor")
 	polling_raw = query.get("polling")
 	limit_raw = query.get("limit")
 
-	before = None if before_raw is None else \
-		float(before_raw) if before_raw.isnumeric() else -1
-	after = None if after_raw is None else \
-		float(after_raw) if after_raw.isnumeric() else -1
+	before = parse_timestamp(before_raw)
+	after = parse_timestamp(after_raw)
 	polling = polling_raw.lower() == "true" or polling_raw == "1" \
 		if polling_raw is not None else True
 	limit = None if limit_raw is None else \
 		int(limit_raw) if limit_raw.isnumeric() else -1
 
+	cursor = None
+	if cursor_raw is not None:
+		try:
+			cursor = decode_cursor(cursor_raw)
+		except ValueError:
+			return respond_error(job, "Invalid query paramater for cursor.")
+
 	if before == -1:
 		return respond_error(job, "Invalid query paramater for before.")
 	if after == -1:
 		return respond_error(job, "Invalid query paramater for after.")
 	if limit == -1:
 		return respond_error(job, "Invalid query paramater for limit.")
-	if before is not None and after is not None:
+	if [before, after, cursor].count(None) < 2:
 		return respond_error(job,
-			"Query paramaters before and after are mutually exclusive.")
+			"Query paramaters before, after and cursor are mutually exclusive.")
 	if limit is not None and (0 >= limit or limit > 200):
 		return respond_error(job, "Query paramater limit was out of range. " +
 			"Must be between 1 and 200 inclusive.")
+	limit = limit if limit is not None else 50
 
-	timestamp = before if before is not None else after \
-		if after is not None else DateTime.now().timestamp()
-	is_before = True if before is not None or after is None else False
-	messages = get_messages_by_timestamp(timestamp, is_before, limit if \
-		limit is not None else 50)
+	if cursor is not None:
+		position, is_before = cursor
+	elif after is not None:
+		position, is_before = position_after(after), False
+	else:
+		position, is_before = position_before(before if before is not None \
+			else DateTime.now().timestamp()), True
+
+	# Long polls wait for something new instead, so they have no entity tag.
+	etag = None
+	if not polling or is_before:
+		etag = messages_etag(community, channel, "latest" \
+			if [before, after, cursor].count(None) == 3 \
+			else encode_cursor(position, is_before), limit)
+		if_none_match = job.headers.get("IF_NONE_MATCH")
+		if if_none_match is not None and matches_etag(if_none_match, (etag,)):
+			return job.close_head(304, {
+				"ETag": etag,
+				"Cache-Control": "private, no-cache"
+			})
+
+	if polling and not is_before:
+		# Subscribe before querying so nothing posted in between is missed.
+		with message_hub.subscribe((community, channel)) as subscription:
+			messages = get_messages(community, channel, position, False, limit)
+			if len(messages) == 0:
+				if long_polls.full:
+					return respond_retry(job, "Too many long polls.", 1, 503)
+				if not long_polls.acquire(authed_user.name):
+					return respond_retry(job, "Too many long polls.", 1)
+
+				items: List[HubItem] = []
+				deadline = monotonic() + 60
+				try:
+					with request_admission.parked():
+						while len(items) == 0 and \
+								(remaining := deadline - monotonic()) > 0:
+							items = [
+								item for item in subscription.wait(remaining) \
+									if item.message.position > position
+							]
+				finally:
+					long_polls.release(authed_user.name)
+
+				content = render_items(items, page_cursors([item.message \
+					for item in items], position, False, limit))
+				job.write_head(200, {
+					"Content-Type": "application/json; charset=utf-8",
+					"Content-Length": str(len(content))
+				})
+				job.close_body(content)
+				return
+	else:
+		messages = get_messages(community, channel, position, is_before, limit)
 
-	if len(messages) == 0 and polling and not is_before:
-		mut_message_event.wait(60)
-		messages = get_messages_by_timestamp(timestamp, False, 1)
+	users = get_users_by_names(message.author for message in messages)
 
-		users = [
-			user for user in \
-				{get_user_by_name(message.author) for message in messages} \
-					if user is not None
-		]
+	content = render_page(users, messages, page_cursors(messages, position,
+		is_before, limit))
+	headers = {
+		"Content-Type": "application/json; charset=utf-8",
+		"Content-Length": str(len(content))
+	}
+	if etag is not None:
+		headers["ETag"] = etag
+		headers["Cache-Control"] = "private, no-cache"
+	job.write_head(200, headers)
+	job.close_body(content)
 
-		content = dump_json({"users": users, "messages": messages}, indent=None)
-		job.write_head(200, {
-			"Content-Type": "application/json; charset=utf-8",
-			"Content-Length": str(len(content))
-		})
-		job.close_body(content)
+def stream_messages(job: HTTPJob, community: str, channel: str):
+	"""Streams new messages of a channel as server-sent events until the stream's
+	lifetime runs out, at which point the client is expected to reconnect. Each
+	event's id is a cursor after its newest message, so a reconnecting client's
+	`Last-Event-ID` resumes right after the last message it received. A plain
+	timestamp is accepted as `Last-Event-ID` too.
+	"""
+
+	global event_stream_count
+
+	if event_stream_count >= max_event_streams:
+		return respond_error(job, "Too many open streams.", 503)
+
+	last_event_id = job.headers.get("LAST_EVENT_ID")
+	if last_event_id is None:
+		position = position_before(DateTime.now().timestamp())
 	else:
-		users = [
-			user for user in \
-				{get_user_by_name(message.author) for message in messages} \
-					if user is not None
-		]
+		try:
+			position, _ = decode_cursor(last_event_id)
+		except ValueError:
+			timestamp = parse_timestamp(last_event_id)
+			if timestamp == -1:
+				return respond_error(job, "Invalid Last-Event-ID header.")
+			position = position_after(timestamp) # type: ignore
+
+	def write_event(newest: Position, data: bytes):
+		job.write_body(["id: " + encode_cursor(newest, False) +
+			"\nevent: messages\ndata: ", data, b"\n\n"])
+
+	event_stream_count += 1
+	try:
+		with message_hub.subscribe((community, channel)) as subscription:
+			job.write_head(200, {
+				"Content-Type": "text/event-stream; charset=utf-8",
+				"Cache-Control": "no-cache"
+			})
+			if isinstance(job, HTTPHeadJob):
+				return
+			# The head is only sent along with the first part of the body.
+			job.write_body("retry: 3000\n\n")
+
+			# Catch up on everything that was missed since Last-Event-ID.
+			if last_event_id is not None:
+				while len(messages := get_messages(community, channel, position,
+						False, 200)) > 0:
+					users = get_users_by_names(message.author for message in messages)
+					position = messages[-1].position
+					write_event(position, render_page(users, messages))
+
+			deadline = monotonic() + event_stream_lifetime
+			with request_admission.parked():
+				while (remaining := deadline - monotonic()) > 0 and \
+						not job.disconnected:
+					items = [
+						item for item in \
+							subscription.wait(min(event_stream_heartbeat, remaining)) \
+								if item.message.position > position
+					]
+					if len(items) == 0:
+						job.write_body(": heartbeat\n\n")
+						continue
+
+					position = items[-1].message.position
+					write_event(position, render_items(items))
+	finally:
+		event_stream_count -= 1
+		job.close_body()
 
-		content = dump_json({"users": users, "messages": messages}, indent=None)
-		job.write_head(200, {
-			"Content-Type": "application/json; charset=utf-8",
-			"Content-Length": str(len(content))
-		})
-		job.close_body(content)
+def post_message(author: User, community: str, channel: str, content: str):
+	"""Stores a new message and publishes it to everyone listening to the
+	channel. Returns the message's encoded JSON.
+	"""
+
+	message = Message(DateTime.now().timestamp(), author, content, community,
+		channel)
+	set_message(message)
+
+	message_json = fragments.fragment(message)
+	message_hub.publish(HubItem((community, channel), message, message_json,
+		fragments.fragment(author)))
+	broadcast("message", {
+		"channel": [community, channel],
+		"message": message,
+		"author": author
+	})
+	return message_json
+
+@on_peer_event("message")
+def on_peer_message(data: Dict[str, Any]):
+	"""Publishes a message posted to another worker to this worker's
+	subscribers.
+	"""
+
+	community, channel = data["channel"]
+	message = Message.from_document(data["message"], community = community,
+		channel = channel)
+	cache_message(message)
+	message_hub.publish(HubItem((community, channel), message,
+		fragments.fragment(message),
+		dump_json(data["author"], indent=None).encode("utf-8")))
 
 @requires_authorization
 def on_post_messages_request(job: HTTPJob, authed_user: User, community: str,
 		channel: str):
-	global mut_message_event
-
-	if community != "_" or channel != "_":
+	if get_channel(community, channel) is None:
 		job.write_head(404, {})
 		job.close_body()
 		return
 
-	body = job.body.read()
+	if (body := job.read_body()) is None:
+		return
 	json_body: Dict[str, Any]
 	try:
 		json_body = load_json(body)
@@ -243,20 +529,52 @@ def on_post_messages_request(job: HTTPJob, authed_user: User, community: str,
 	content = content_unstripped.strip()
 	if content == "":
 		return respond_error(job, "Cannot send empty message.")
+	if (wait := message_limits.take(authed_user.name)) > 0:
+		return respond_retry(job, "Too many messages.", wait)
 
-	message = Message(DateTime.now().timestamp(), authed_user, content)
-	set_message(message)
-
-	mut_message_event.set()
-	mut_message_event = Event()
-	message_json = dump_json(message, indent=None)
+	message_json = post_message(authed_user, community, channel, content)
 	job.write_head(200, {
 		"Content-Type": "application/json; charset=utf-8",
 		"Content-Length": str(len(message_json))
 	})
 	job.close_body(message_json)
 
+def on_get_health_request(job: HTTPJob):
+	"""Answers whether this process is ready, along with how long each phase of
+	starting it took. This is answered even while starting up.
+	"""
+
+	content = dump_json(startup_phases.to_json(), indent=None).encode("utf-8")
+	job.write_head(200 if startup_phases.ready.is_set() else 503, {
+		"Content-Type": "application/json; charset=utf-8",
+		"Content-Length": str(len(content)),
+		"Cache-Control": "no-store"
+	})
+	job.close_body(content)
+
+def on_get_metrics_request(job: HTTPJob):
+	# Every request comes through the proxy, so metrics are only served to
+	# scrapers that know METRICS_TOKEN, and not at all without one.
+	if metrics_token is None:
+		return job.close_head(404, {})
+	if not compare_digest(job.headers.get("AUTHORIZATION", "").encode("utf-8"),
+			f"Bearer {metrics_token}".encode("utf-8")):
+		return respond_error(job, "Invalid metrics token.", 401)
+
+	content = metrics.render()
+	job.write_head(200, {
+		"Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+		"Content-Length": str(len(content))
+	})
+	job.close_body(content)
+
 endpoints = {
+	generate_endpoint(HEALTH_PATH, {
+		"GET": on_get_health_request
+	}),
+	generate_endpoint("/api/v1/metrics", {
+		"GET": on_get_metrics_request
+	}),
 	generate_endpoint("/api/v1/communities//channels//messages", {
 		"GET": on_get_messages_request,
 		"POST": on_post_messages_request
@@ -264,23 +582,42 @@ endpoints = {
 	generate_endpoint("/api/v1/me", {
 		"GET": on_get_me_request,
 		"POST": on_post_me_request
+	}),
+	generate_endpoint("/api/v1/sessions", {
+		"POST": on_post_sessions_request,
+		"DELETE": on_delete_sessions_request
 	})
-} | {
-	endpoint 
-		for loc, fil in (load_json(open(path.join(path.dirname(__file__),
-			"../frontendmap.json"), "r").read()).items())
-				for endpoint in static_routes([loc],
-					file = path.join(path.dirname(__file__), "../assets", fil))
 }
 
+router = Router(endpoints)
+
+def add_static_routes():
+	"""Adds a route for every page of `frontendmap.json`, which is only read
+	during startup so that importing the server does no I/O.
+	"""
+
+	with open(path.join(path.dirname(__file__), "../frontendmap.json"),
+			"r") as file:
+		frontend_map: Dict[str, str] = load_json(file.read())
+	for loc, fil in frontend_map.items():
+		for endpoint in static_routes([loc],
+				file = path.join(path.dirname(__file__), "../assets", fil)):
+			router.add(endpoint)
+
 def handler(job: HTTPJob):
-	endpoint = next((endpoint for endpoint in endpoints \
-		if len(endpoint.expression) == len(job.path) and \
-			all((end_part is None or end_part == job.path[ind]) \
-				for ind, end_part in enumerate(endpoint.expression))), None)
+	started = perf_counter()
+	route = router.resolve(job.path)
 
-	if endpoint is not None:
-		endpoint(job)
-	else:
-		job.write_head(404, {})
-		job.close_body()
+	try:
+		if route is not None:
+			endpoint, parameters = route
+			endpoint.handle(job, parameters)
+		else:
+			job.write_head(404, {})
+			job.close_body()
+	finally:
+		# Only known routes are labeled, so that scanners can't grow the metrics.
+		name = route[0].route if route is not None else "unmatched"
+		method = job.method if job.method in metric_methods else "other"
+		request_duration.observe(perf_counter() - started, name, method)
+		request_count.inc(name, method, str(job.status_code or 500))
@@ -0,0 +1,345 @@
+from gevent import Greenlet, getcurrent, sleep, spawn
+from gevent.queue import Full, Queue
+from socket import SHUT_RDWR, error as SocketError
+from base64 import b64encode
+from hashlib import sha1
+from struct import pack, unpack
+from time import monotonic
+from os import getenv
+from urllib.parse import parse_qsl, urlparse
+from typing import Any, BinaryIO, Dict, Hashable, Optional, Tuple, Union
+from .hub import Subscription, render_items
+from .utilities import JSONDecodeError, dump_json, load_json
+from .database import User, get_channel
+from .endpoints import get_authorized_user, message_hub, message_limits, \
+	post_message, request_admission
+
+GATEWAY_PATH = "/api/v1/gateway"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+max_frame_size = int(getenv("GATEWAY_MAX_FRAME_SIZE", 64 * 1024))
+max_queued_frames = int(getenv("GATEWAY_MAX_QUEUED_FRAMES", 256))
+# Either "disconnect" or "drop", what to do with a client that can't keep up.
+slow_consumer_policy = getenv("GATEWAY_SLOW_CONSUMER", "disconnect")
+ping_interval = float(getenv("GATEWAY_PING_INTERVAL", 20))
+
+class WebSocketClosed(Exception):
+	def __init__(self, code: int = 1000, reason: str = ""):
+		super().__init__(code, reason)
+		self.code = code
+		self.reason = reason
+
+def websocket_accept(key: str) -> str:
+	"""Computes the `Sec-WebSocket-Accept` header value for a handshake key.
+	"""
+
+	return b64encode(sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()) \
+		.decode("ascii")
+
+def encode_frame(opcode: int, payload: bytes = b"") -> bytes:
+	"""Encodes a single, final, unmasked frame as sent by a server.
+	"""
+
+	length = len(payload)
+	if length < 126:
+		header = pack("!BB", 0x80 | opcode, length)
+	elif length < 0x10000:
+		header = pack("!BBH", 0x80 | opcode, 126, length)
+	else:
+		header = pack("!BBQ", 0x80 | opcode, 127, length)
+	return header + payload
+
+def _read_exact(rfile: BinaryIO, size: int) -> bytes:
+	data = rfile.read(size)
+	if data is None or len(data) < size:
+		raise WebSocketClosed(1006, "Connection lost.")
+	return data
+
+def read_frame(rfile: BinaryIO) -> Tuple[bool, int, bytes]:
+	"""Reads a single frame sent by a client, returning whether it is final, its
+	opcode and its unmasked payload.
+	"""
+
+	first, second = _read_exact(rfile, 2)
+	fin = bool(first & 0x80)
+	opcode = first & 0x0F
+	length = second & 0x7F
+	if not second & 0x80:
+		raise WebSocketClosed(1002, "Client frames must be masked.")
+
+	if length == 126:
+		length = unpack("!H", _read_exact(rfile, 2))[0]
+	elif length == 127:
+		length = unpack("!Q", _read_exact(rfile, 8))[0]
+	if length > max_frame_size:
+		raise WebSocketClosed(1009, "Frame too large.")
+
+	mask = _read_exact(rfile, 4)
+	payload = _read_exact(rfile, length)
+	if length > 0:
+		# XOR the whole payload at once as one big integer.
+		key = (mask * (length // 4 + 1))[:length]
+		payload = (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")) \
+			.to_bytes(length, "big")
+	return fin, opcode, payload
+
+class GatewayConnection:
+	"""A WebSocket connection authenticated as `user`. Outgoing frames go through
+	a bounded queue drained by a writer greenlet, so a slow client never blocks
+	anyone publishing to it. When the queue is full the client is either
+	disconnected or the frame is dropped, depending on `slow_consumer_policy`.
+
+	Client messages are JSON objects with a `type`:
+
+	- `subscribe` and `unsubscribe`, with `community` and `channel`.
+	- `send`, with `community`, `channel`, `content` and an optional `nonce` that
+	is echoed back in the `sent` reply.
+	"""
+
+	def __init__(self, socket: Any, rfile: BinaryIO, user: User):
+		self.socket = socket
+		self.rfile = rfile
+		self.user = user
+		self.closed = False
+		self._queue: Queue = Queue(max_queued_frames)
+		self._subscriptions: Dict[Hashable, Tuple[Subscription, Greenlet]] = {}
+		self._last_pong = monotonic()
+		self._writer: Optional[Greenlet] = None
+		self._pinger: Optional[Greenlet] = None
+
+	def run(self):
+		self._writer = spawn(self._write_loop)
+		self._pinger = spawn(self._ping_loop)
+		self.subscribe("_", "_")
+
+		code, reason = 1000, ""
+		try:
+			self._read_loop()
+		except WebSocketClosed as closed:
+			code, reason = closed.code, closed.reason
+		except SocketError:
+			code = 1006
+		finally:
+			self.close(code, reason)
+			self._writer.join(5)
+			self._writer.kill()
+
+	def _read_loop(self):
+		fragments = []
+		fragments_opcode = OP_TEXT
+		while not self.closed:
+			fin, opcode, payload = read_frame(self.rfile)
+
+			if opcode == OP_CLOSE:
+				code = unpack("!H", payload[:2])[0] if len(payload) >= 2 else 1000
+				raise WebSocketClosed(code)
+			elif opcode == OP_PING:
+				self.send(payload, OP_PONG)
+				continue
+			elif opcode == OP_PONG:
+				self._last_pong = monotonic()
+				continue
+			elif opcode == OP_CONTINUATION:
+				if len(fragments) == 0:
+					raise WebSocketClosed(1002, "Unexpected continuation frame.")
+			elif len(fragments) > 0:
+				raise WebSocketClosed(1002, "Expected continuation frame.")
+			else:
+				fragments_opcode = opcode
+
+			fragments.append(payload)
+			if sum(len(fragment) for fragment in fragments) > max_frame_size:
+				raise WebSocketClosed(1009, "Message too large.")
+			if not fin:
+				continue
+
+			data = b"".join(fragments)
+			fragments = []
+			if fragments_opcode != OP_TEXT:
+				raise WebSocketClosed(1003, "Only text messages are accepted.")
+			try:
+				self._on_message(data.decode("utf-8"))
+			except UnicodeDecodeError:
+				raise WebSocketClosed(1007, "Invalid UTF-8.")
+
+	def _on_message(self, text: str):
+		try:
+			message = load_json(text)
+		except JSONDecodeError:
+			return self.send_error("Invalid message.")
+		if type(message) is not dict:
+			return self.send_error("Bad json structure.")
+
+		kind = message.get("type")
+		community = message.get("community", "_")
+		channel = message.get("channel", "_")
+		if type(community) is not str or type(channel) is not str:
+			return self.send_error("Bad json structure.")
+		if get_channel(community, channel) is None:
+			return self.send_error("Unknown channel.")
+
+		if kind == "subscribe":
+			self.subscribe(community, channel)
+		elif kind == "unsubscribe":
+			self.unsubscribe(community, channel)
+		elif kind == "send":
+			content_unstripped = message.get("content")
+			if type(content_unstripped) is not str:
+				return self.send_error("Bad json structure.")
+			content = content_unstripped.strip()
+			if content == "":
+				return self.send_error("Cannot send empty message.")
+
+			if message_limits.take(self.user.name) > 0:
+				return self.send_error("Too many messages.")
+			message_json = post_message(self.user, community, channel, content)
+			self.send(b'{"type":"sent","nonce":' + dump_json(message.get("nonce"),
+				indent=None).encode("utf-8") + b',"message":' + message_json + b"}")
+		else:
+			self.send_error("Unknown message type.")
+
+	def subscribe(self, community: str, channel: str):
+		key = (community, channel)
+		if key not in self._subscriptions:
+			subscription = message_hub.subscribe(key)
+			self._subscriptions[key] = (subscription,
+				spawn(self._forward, subscription))
+
+	def unsubscribe(self, community: str, channel: str):
+		subscribed = self._subscriptions.pop((community, channel), None)
+		if subscribed is not None:
+			subscribed[0].close()
+			subscribed[1].kill()
+
+	def _forward(self, subscription: Subscription):
+		community, channel = subscription.channel
+		prefix = ('{"type":"messages","community":' + \
+			dump_json(community, indent=None) + ',"channel":' + \
+			dump_json(channel, indent=None) + ",").encode("utf-8")
+		while not self.closed:
+			items = subscription.wait()
+			if len(items) > 0:
+				# Splice the rendered page into the event object.
+				self.send(prefix + render_items(items)[1:])
+
+	def send(self, data: Union[str, bytes], opcode: int = OP_TEXT):
+		"""Queues a frame to be sent. Returns whether the frame was queued.
+		"""
+
+		if self.closed:
+			return False
+		payload = data.encode("utf-8") if isinstance(data, str) else data
+		try:
+			self._queue.put_nowait(encode_frame(opcode, payload))
+			return True
+		except Full:
+			if slow_consumer_policy != "drop":
+				self.close(1008, "Client is too slow.")
+			return False
+
+	def send_error(self, message: str):
+		self.send(dump_json({"type": "error", "message": message}, indent=None))
+
+	def close(self, code: int = 1000, reason: str = ""):
+		if self.closed:
+			return
+		self.closed = True
+
+		# Greenlets that call this themselves stop on their own once closed is set.
+		current = getcurrent()
+		for subscription, forwarder in self._subscriptions.values():
+			subscription.close()
+			if forwarder is not current:
+				forwarder.kill(block = False)
+		self._subscriptions = {}
+		if self._pinger is not None and self._pinger is not current:
+			self._pinger.kill(block = False)
+
+		frame = encode_frame(OP_CLOSE, pack("!H", code) + reason.encode("utf-8"))
+		try:
+			self._queue.put_nowait(frame)
+			self._queue.put_nowait(None)
+		except Full:
+			# The client isn't reading, so don't bother saying goodbye.
+			if self._writer is not None:
+				self._writer.kill(block = False)
+			self._shutdown()
+
+	def _write_loop(self):
+		try:
+			for frame in self._queue:
+				if frame is None:
+					break
+				self.socket.sendall(frame)
+		except SocketError:
+			pass
+		finally:
+			self.closed = True
+			self._shutdown()
+
+	def _ping_loop(self):
+		while not self.closed:
+			sleep(ping_interval)
+			if monotonic() - self._last_pong > ping_interval * 2:
+				self.close(1001, "Ping timed out.")
+				return
+			self.send(b"", OP_PING)
+
+	def _shutdown(self):
+		# Wakes up the reader, which is blocked on the socket.
+		try:
+			self.socket.shutdown(SHUT_RDWR)
+		except SocketError:
+			pass
+
+def handle_gateway(handler: Any):
+	"""Upgrades the connection of a `WSGIHandler` to a WebSocket and runs the
+	gateway on it until it closes. The connection is authenticated once, with
+	either the `Authorization` header or, since browsers can't set headers on
+	WebSockets, an `authorization` query parameter. The query parameter only
+	takes a Bearer session token, so that passwords never end up in the request
+	line.
+	"""
+
+	environ = handler.environ
+	key = environ.get("HTTP_SEC_WEBSOCKET_KEY")
+	authorization = environ.get("HTTP_AUTHORIZATION")
+	if authorization is None:
+		query = dict(parse_qsl(urlparse(environ.get("REQUEST_URI", "")).query))
+		authorization = query.get("authorization")
+		if authorization is not None and \
+				not authorization.lower().startswith("bearer "):
+			authorization = None
+	user = get_authorized_user(authorization)
+
+	if key is None or environ.get("HTTP_SEC_WEBSOCKET_VERSION") != "13":
+		status = b"400 Bad Request"
+	elif user is None:
+		status = b"401 Unauthorized"
+	else:
+		status = None
+
+	if status is not None:
+		handler.socket.sendall(b"HTTP/1.1 " + status +
+			b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+		return status.decode("ascii")
+
+	handler.socket.sendall(
+		b"HTTP/1.1 101 Switching Protocols\r\n" +
+		b"Upgrade: websocket\r\n" +
+		b"Connection: Upgrade\r\n" +
+		b"Sec-WebSocket-Accept: " + websocket_accept(key).encode("ascii") +
+		b"\r\n\r\n")
+
+	assert user is not None
+	# The connection lives on, so it doesn't hold on to its request's slot.
+	with request_admission.parked():
+		GatewayConnection(handler.socket, handler.rfile, user).run()
+	return "101 Switching Protocols"
@@ -0,0 +1,94 @@
+from gevent.event import Event
+from typing import Any, Dict, Hashable, List, Optional, Set
+
+class HubItem:
+	"""A published message along with its author, both already encoded as JSON so
+	that subscribers can respond without encoding or querying anything.
+	"""
+
+	__slots__ = ("channel", "message", "content", "author")
+
+	def __init__(self, channel: Hashable, message: Any, content: bytes,
+			author: bytes):
+		self.channel = channel
+		self.message = message
+		self.content = content
+		self.author = author
+
+class Subscription:
+	"""A subscriber's view of one channel of a `MessageHub`. Items published
+	while nobody is waiting are kept, so that one wake up receives every message
+	that arrived in the meantime. Subscriptions are context managers that
+	unsubscribe on exit.
+	"""
+
+	def __init__(self, hub: "MessageHub", channel: Hashable):
+		self.hub = hub
+		self.channel = channel
+		self._items: List[HubItem] = []
+		self._event = Event()
+
+	def put(self, item: HubItem):
+		self._items.append(item)
+		self._event.set()
+
+	def wait(self, timeout: Optional[float] = None) -> List[HubItem]:
+		"""Waits for at least one item to be published, and returns every item
+		published since the last call. Returns an empty list if `timeout` seconds
+		pass first.
+		"""
+
+		if len(self._items) == 0:
+			self._event.wait(timeout)
+
+		items = self._items
+		self._items = []
+		self._event.clear()
+		return items
+
+	def close(self):
+		self.hub.unsubscribe(self)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+class MessageHub:
+	"""Delivers published messages directly to every subscription of the
+	message's channel.
+	"""
+
+	def __init__(self):
+		self._subscriptions: Dict[Hashable, Set[Subscription]] = {}
+
+	def subscribe(self, channel: Hashable) -> Subscription:
+		subscription = Subscription(self, channel)
+		self._subscriptions.setdefault(channel, set()).add(subscription)
+		return subscription
+
+	def unsubscribe(self, subscription: Subscription):
+		subscriptions = self._subscriptions.get(subscription.channel)
+		if subscriptions is not None:
+			subscriptions.discard(subscription)
+			if len(subscriptions) == 0:
+				del self._subscriptions[subscription.channel]
+
+	def publish(self, item: HubItem):
+		for subscription in tuple(self._subscriptions.get(item.channel, ())):
+			subscription.put(item)
+
+	def subscriber_count(self, channel: Optional[Hashable] = None) -> int:
+		if channel is not None:
+			return len(self._subscriptions.get(channel, ()))
+		return sum(len(subs) for subs in self._subscriptions.values())
+
+def render_items(items: List[HubItem], cursors: bytes = b"") -> bytes:
+	"""Joins the pre-encoded JSON of `items` into a messages response body, with
+	each author included once, followed by the pre-encoded `cursors` if given.
+	"""
+
+	authors = {item.message.author: item.author for item in items}.values()
+	return b'{"users":[' + b",".join(authors) + b'],"messages":[' + \
+		b",".join(item.content for item in items) + b"]" + cursors + b"}"
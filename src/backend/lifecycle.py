@@ -0,0 +1,69 @@
+from gevent.event import Event
+from contextlib import contextmanager
+from sys import stderr
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from .metrics import metrics
+
+class StartupPhases:
+	"""Times each phase of starting a process, from importing the server to
+	being ready to answer requests. `ready` is set once every phase finished,
+	and `failed` holds the error of a phase that didn't.
+	"""
+
+	def __init__(self):
+		self.started = perf_counter()
+		self.phases: List[Tuple[str, float]] = []
+		self.current: Optional[str] = None
+		self.finished: Optional[float] = None
+		self.failed: Optional[BaseException] = None
+		self.ready = Event()
+
+	@contextmanager
+	def phase(self, name: str) -> Iterator[None]:
+		self.current = name
+		started = perf_counter()
+		try:
+			yield
+		except BaseException as error:
+			self.failed = error
+			raise
+		finally:
+			self.phases.append((name, perf_counter() - started))
+			self.current = None
+
+	def record(self, name: str, seconds: float):
+		self.phases.append((name, seconds))
+
+	def finish(self):
+		self.finished = perf_counter()
+		self.ready.set()
+		print(self.report(), file = stderr)
+
+	@property
+	def status(self) -> str:
+		if self.ready.is_set():
+			return "ready"
+		return "failed" if self.failed is not None else "starting"
+
+	def to_json(self) -> Dict[str, Any]:
+		return {
+			"status": self.status,
+			"phase": self.current,
+			"phases": {name: round(seconds, 6) for name, seconds in self.phases},
+			"uptime": perf_counter() - self.started
+		}
+
+	def report(self) -> str:
+		total = (self.finished or perf_counter()) - self.started
+		lines = [f"Ready {total * 1000:.1f} ms after starting to import:"]
+		lines += [
+			f"  {name:<12}{seconds * 1000:>10.1f} ms" for name, seconds in self.phases
+		]
+		return "\n".join(lines)
+
+startup_phases = StartupPhases()
+metrics.gauge("startup_phase_seconds", "How long each phase of starting this " +
+	"process took.", lambda: {
+		(name,): seconds for name, seconds in startup_phases.phases
+	}, ("phase",))
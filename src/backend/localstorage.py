@@ -0,0 +1,477 @@
+from gevent import get_hub
+from bisect import bisect_left, bisect_right
+from fcntl import LOCK_EX, LOCK_NB, flock
+from json import dumps, loads
+from mmap import ACCESS_READ, mmap
+from struct import Struct
+from sys import stderr
+from threading import Lock
+from time import time
+from zlib import crc32
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, \
+	Tuple
+from .storage import Document, Storage
+from .timeline import Position
+import os
+
+# Every record is the length and CRC-32 of its JSON, followed by the JSON.
+_header = Struct("<II")
+
+def _encode_record(record: Document) -> bytes:
+	payload = dumps(record, separators=(",", ":")).encode("utf-8")
+	return _header.pack(len(payload), crc32(payload)) + payload
+
+def _in_thread(function: Callable[..., Any], *args: Any) -> Any:
+	"""Runs blocking disk work on an operating system thread, so the event loop
+	keeps serving other requests meanwhile.
+	"""
+
+	return get_hub().threadpool.apply(function, args)
+
+def _fsync_directory(path: str):
+	directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+	try:
+		os.fsync(directory)
+	finally:
+		os.close(directory)
+
+class RecordLog:
+	"""An append-only file of checksummed JSON records, read through a memory
+	map. Appends are handed to the operating system right away, so they survive
+	the process crashing, and `sync` flushes them to disk.
+	"""
+
+	def __init__(self, path: str):
+		self.path = path
+		# Left behind by a compaction that didn't finish.
+		if os.path.exists(path + ".compact"):
+			os.remove(path + ".compact")
+		self._file = open(path, "a+b")
+		self._map: Optional[mmap] = None
+		self.size = os.fstat(self._file.fileno()).st_size
+
+	def _view(self, end: int) -> mmap:
+		# The map only covers the file as it was when mapped.
+		if self._map is None or len(self._map) < end:
+			if self._map is not None:
+				self._map.close()
+			self._map = mmap(self._file.fileno(), 0, access = ACCESS_READ)
+		return self._map
+
+	def replay(self) -> Iterator[Tuple[int, Document]]:
+		"""Yields every record along with its offset. A crash in the middle of an
+		append leaves a torn record at the end, which is truncated away once
+		everything before it was yielded.
+		"""
+
+		offset = 0
+		while offset + _header.size <= self.size:
+			view = self._view(self.size)
+			length, checksum = _header.unpack_from(view, offset)
+			start = offset + _header.size
+			payload = view[start:start + length]
+			if len(payload) < length or crc32(payload) != checksum:
+				break
+			yield offset, loads(payload)
+			offset = start + length
+
+		if offset < self.size:
+			print(f"Truncating {self.size - offset} bytes of {self.path} left by " +
+				"an incomplete write.", file = stderr)
+			if self._map is not None:
+				self._map.close()
+				self._map = None
+			self._file.truncate(offset)
+			self.size = offset
+
+	def append(self, record: Document) -> int:
+		"""Appends a record, returning its offset.
+		"""
+
+		data = _encode_record(record)
+		offset = self.size
+		try:
+			self._file.write(data)
+			self._file.flush()
+		except OSError:
+			# Don't leave a torn record in front of the next one.
+			self._file.truncate(offset)
+			raise
+		self.size += len(data)
+		return offset
+
+	def read(self, offset: int) -> Document:
+		length, _ = _header.unpack_from(self._view(offset + _header.size), offset)
+		start = offset + _header.size
+		return loads(self._view(start + length)[start:start + length])
+
+	def read_all(self, offsets: Iterable[int]) -> Iterator[Document]:
+		"""Reads the records at `offsets` through a file of its own rather than the
+		memory map, so that it can be used from another thread.
+		"""
+
+		with open(self.path, "rb") as file:
+			for offset in offsets:
+				file.seek(offset)
+				length, _ = _header.unpack(file.read(_header.size))
+				yield loads(file.read(length))
+
+	def write_compacted(self, records: Iterable[Document]) -> List[int]:
+		"""Writes `records` to a new log next to this one, returning their offsets
+		in it. Only touches the new log, so it can run on another thread while
+		records are still appended to this one. `swap_compacted` swaps it in.
+		"""
+
+		offsets = []
+		size = 0
+		with open(self.path + ".compact", "wb") as file:
+			for record in records:
+				data = _encode_record(record)
+				file.write(data)
+				offsets.append(size)
+				size += len(data)
+			file.flush()
+			os.fsync(file.fileno())
+		return offsets
+
+	def copy_appended(self, start: int, end: int):
+		"""Copies the records between `start` and `end` of this log to the end of
+		the new log from `write_compacted` and flushes it to disk. Only reads
+		records that are already written, so it can run on another thread too.
+		"""
+
+		with open(self.path, "rb") as source, \
+				open(self.path + ".compact", "ab") as file:
+			source.seek(start)
+			file.write(source.read(end - start))
+			file.flush()
+			os.fsync(file.fileno())
+
+	def swap_compacted(self, copied: int) -> int:
+		"""Replaces this log with the new one, which holds everything up to
+		`copied` bytes into this log. The few records appended since are copied
+		over without waiting for the disk, like any other append, and the
+		returned distance is how far every record after the compacted ones moved.
+		Everything else is on disk before the swap, so a crash leaves one log or
+		the other.
+		"""
+
+		temporary = self.path + ".compact"
+		tail = os.pread(self._file.fileno(), self.size - copied, copied)
+		with open(temporary, "ab") as file:
+			file.write(tail)
+			size = file.tell()
+
+		distance = size - self.size
+		self.close()
+		os.replace(temporary, self.path)
+		self._file = open(self.path, "a+b")
+		self.size = size
+		return distance
+
+	def sync(self):
+		self._file.flush()
+		# A copy of the descriptor stays valid even if the log is swapped or closed
+		# while the thread is still flushing it.
+		descriptor = os.dup(self._file.fileno())
+		try:
+			_in_thread(os.fsync, descriptor)
+		finally:
+			os.close(descriptor)
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		self._file.close()
+
+class ChannelIndex:
+	"""The positions of a channel's messages in order, along with the offset of
+	each message in the log.
+	"""
+
+	__slots__ = ("positions", "offsets")
+
+	def __init__(self):
+		self.positions: List[Position] = []
+		self.offsets: List[int] = []
+
+	def insert(self, position: Position, offset: int) -> bool:
+		"""Indexes a message, replacing the message at the same position if there
+		is one. Returns whether one was replaced.
+		"""
+
+		if len(self.positions) == 0 or position > self.positions[-1]:
+			self.positions.append(position)
+			self.offsets.append(offset)
+			return False
+
+		ind = bisect_left(self.positions, position)
+		if ind < len(self.positions) and self.positions[ind] == position:
+			self.offsets[ind] = offset
+			return True
+		self.positions.insert(ind, position)
+		self.offsets.insert(ind, offset)
+		return False
+
+	def find(self, position: Position) -> Optional[int]:
+		ind = bisect_left(self.positions, position)
+		if ind < len(self.positions) and self.positions[ind] == position:
+			return self.offsets[ind]
+		return None
+
+	def page(self, position: Position, before: bool, limit: int) -> List[int]:
+		if before:
+			end = bisect_left(self.positions, position)
+			return self.offsets[max(end - limit, 0):end][::-1]
+		start = bisect_right(self.positions, position)
+		return self.offsets[start:start + limit]
+
+_tables = ("users", "channels", "invites", "sessions")
+
+class LocalStorage(Storage):
+	"""Stores everything in the directory `path`, without a database server.
+
+	Messages are appended to `messages.log` and indexed in memory by channel and
+	position, so a page is a binary search followed by reads from the memory
+	map. Users, channels, invites and sessions are few and small enough to be
+	kept in memory entirely, and every change to them is appended to
+	`tables.log`.
+
+	Both logs are replayed on startup, which also recovers from a crash in the
+	middle of a write. Replaced records still take up space, and once they make
+	up more than `compact_ratio` of a log, `expire` compacts it.
+
+	Only one process can use the directory at a time.
+	"""
+
+	shared = False
+
+	def __init__(self, path: str, compact_ratio: float = 0.5):
+		os.makedirs(path, exist_ok = True)
+		self.compact_ratio = compact_ratio
+		self._lock = Lock()
+		self._lock_file = open(os.path.join(path, "lock"), "w")
+		try:
+			flock(self._lock_file, LOCK_EX | LOCK_NB)
+		except BlockingIOError:
+			raise RuntimeError(f"{path} is already used by another process.")
+
+		self._messages = RecordLog(os.path.join(path, "messages.log"))
+		self._channels: Dict[Tuple[str, str], ChannelIndex] = {}
+		self._message_count = 0
+		self._message_records = 0
+		for offset, record in self._messages.replay():
+			self._index_message(record, offset)
+
+		self._tables_log = RecordLog(os.path.join(path, "tables.log"))
+		self._tables: Dict[str, Dict[Tuple, Document]] = {
+			table: {} for table in _tables
+		}
+		self._table_records = 0
+		for _, record in self._tables_log.replay():
+			self._apply(record)
+
+	def bootstrap(self, check_plans: bool = False):
+		if self.get_channel("_", "_") is None:
+			self.put_channel({"community": "_", "channel": "_", "about": None})
+
+	def _apply(self, record: Document):
+		table = self._tables[record["t"]]
+		key = tuple(record["k"])
+		if record["d"] is None:
+			table.pop(key, None)
+		else:
+			table[key] = record["d"]
+		self._table_records += 1
+
+	def _get(self, table: str, key: Tuple) -> Optional[Document]:
+		with self._lock:
+			document = self._tables[table].get(key)
+		return dict(document) if document is not None else None
+
+	def _put(self, table: str, key: Tuple, document: Optional[Document]):
+		# Copied, since the document may be an object's live attributes.
+		record = {
+			"t": table,
+			"k": list(key),
+			"d": dict(document) if document is not None else None
+		}
+		with self._lock:
+			self._tables_log.append(record)
+			self._apply(record)
+
+	def _index_message(self, document: Document, offset: int):
+		index = self._channels.get((document["community"], document["channel"]))
+		if index is None:
+			index = self._channels[(document["community"], document["channel"])] = \
+				ChannelIndex()
+		if not index.insert((document["timestamp"], document["author"]), offset):
+			self._message_count += 1
+		self._message_records += 1
+
+	def _should_compact(self, live: int, records: int) -> bool:
+		return records - live > self.compact_ratio * records and records > 1000
+
+	def expire(self):
+		"""Deletes expired sessions, compacts logs with too many replaced records
+		and flushes both logs to disk. The disk work runs on a thread, and the
+		lock is only held to snapshot a log and to rename the compacted one over
+		it, so neither the event loop nor other storage operations wait for the
+		disk.
+		"""
+
+		now = time()
+		expired = [
+			key for key, session in list(self._tables["sessions"].items()) \
+				if now >= session["expires"]
+		]
+		for key in expired:
+			self._put("sessions", key, None)
+
+		self._compact_tables()
+		self._compact_messages()
+		self._tables_log.sync()
+		self._messages.sync()
+
+	def _compact_tables(self):
+		with self._lock:
+			live = sum(len(table) for table in self._tables.values())
+			if not self._should_compact(live, self._table_records):
+				return
+			records = [
+				{"t": name, "k": list(key), "d": document} \
+					for name, table in self._tables.items() \
+						for key, document in table.items()
+			]
+			compacted, compacted_records = self._tables_log.size, self._table_records
+
+		written = len(_in_thread(self._tables_log.write_compacted, records))
+		copied = self._copy_appended(self._tables_log, compacted)
+		with self._lock:
+			self._tables_log.swap_compacted(copied)
+			self._table_records += written - compacted_records
+		_in_thread(_fsync_directory, self._tables_log.path)
+
+	def _compact_messages(self):
+		with self._lock:
+			if not self._should_compact(self._message_count, self._message_records):
+				return
+			old_offsets = [
+				offset for index in self._channels.values() \
+					for offset in index.offsets
+			]
+			compacted, compacted_records = self._messages.size, \
+				self._message_records
+
+		new_offsets = _in_thread(self._messages.write_compacted,
+			self._messages.read_all(old_offsets))
+		moved = dict(zip(old_offsets, new_offsets))
+		copied = self._copy_appended(self._messages, compacted)
+		with self._lock:
+			distance = self._messages.swap_compacted(copied)
+			# Messages stored since the snapshot were copied over along with the rest
+			# of the log after it.
+			for index in self._channels.values():
+				index.offsets = [
+					moved[offset] if offset < compacted else offset + distance \
+						for offset in index.offsets
+				]
+			self._message_records += len(new_offsets) - compacted_records
+		_in_thread(_fsync_directory, self._messages.path)
+
+	def _copy_appended(self, log: RecordLog, compacted: int) -> int:
+		"""Copies what was appended to `log` while it was being compacted to the
+		new log and flushes it to disk, all without the lock, so that swapping only
+		has to copy whatever was appended after that. Returns how much of `log`
+		was copied.
+		"""
+
+		copied = log.size
+		_in_thread(log.copy_appended, compacted, copied)
+		return copied
+
+	def close(self):
+		with self._lock:
+			self._tables_log.close()
+			self._messages.close()
+			self._lock_file.close()
+
+	def get_user(self, name: str) -> Optional[Document]:
+		return self._get("users", (name,))
+
+	def get_users(self, names: List[str]) -> List[Document]:
+		return [
+			user for name in names \
+				if (user := self._get("users", (name,))) is not None
+		]
+
+	def put_user(self, document: Document):
+		self._put("users", (document["name"],), document)
+
+	def get_channel(self, community: str, channel: str) -> Optional[Document]:
+		return self._get("channels", (community, channel))
+
+	def get_channels(self) -> Iterable[Document]:
+		with self._lock:
+			return [dict(document) for document in self._tables["channels"].values()]
+
+	def put_channel(self, document: Document):
+		self._put("channels", (document["community"], document["channel"]),
+			document)
+
+	def get_open_invite(self, code: str) -> Optional[Document]:
+		invite = self._get("invites", (code,))
+		return invite if invite is not None and invite["accepter"] is None \
+			else None
+
+	def put_invite(self, code: str, document: Document):
+		if self.get_open_invite(code) is not None:
+			self._put("invites", (code,), document)
+
+	def get_session(self, token_hash: str) -> Optional[Document]:
+		return self._get("sessions", (token_hash,))
+
+	def put_session(self, document: Document):
+		self._put("sessions", (document["token"],), document)
+
+	def delete_session(self, token_hash: str):
+		if self._get("sessions", (token_hash,)) is not None:
+			self._put("sessions", (token_hash,), None)
+
+	def get_message(self, community: str, channel: str, timestamp: float,
+			author: str) -> Optional[Document]:
+		with self._lock:
+			index = self._channels.get((community, channel))
+			offset = index.find((timestamp, author)) if index is not None else None
+			return self._messages.read(offset) if offset is not None else None
+
+	def put_message(self, document: Document):
+		with self._lock:
+			self._index_message(document, self._messages.append(document))
+
+	def insert_messages(self, documents: List[Document]) -> \
+			Dict[int, BaseException]:
+		failures: Dict[int, BaseException] = {}
+		with self._lock:
+			for ind, document in enumerate(documents):
+				index = self._channels.get((document["community"],
+					document["channel"]))
+				if index is not None and \
+						index.find((document["timestamp"], document["author"])) is not None:
+					continue
+				try:
+					self._index_message(document, self._messages.append(document))
+				except OSError as error:
+					failures[ind] = error
+		return failures
+
+	def get_messages(self, community: str, channel: str, position: Position,
+			before: bool, limit: int) -> List[Document]:
+		with self._lock:
+			index = self._channels.get((community, channel))
+			if index is None:
+				return []
+			# The records are returned as is, community and channel included.
+			return list(map(self._messages.read, index.page(position, before,
+				limit)))
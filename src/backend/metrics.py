@@ -0,0 +1,192 @@
+from gevent import sleep, spawn
+from bisect import bisect_left
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, \
+	Union
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Labels, float]
+
+# In seconds, suited to anything from a cache lookup to a long poll.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+	0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+	pairs = [f'{name}="{_escape(str(value))}"' for name, value in \
+		zip(names, values)]
+	return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def _format_value(value: float) -> str:
+	if value != value:
+		return "NaN"
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+	"""A value that only goes up, with a separate value for every combination of
+	labels.
+	"""
+
+	kind = "counter"
+
+	def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = ()):
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self._values: Dict[Labels, float] = {}
+
+	def inc(self, *labels: str, amount: float = 1):
+		self._values[labels] = self._values.get(labels, 0) + amount
+
+	def samples(self) -> Iterator[Sample]:
+		for labels, value in list(self._values.items()):
+			yield self.name, labels, value
+
+class Histogram:
+	"""Counts observations into cumulative `buckets`, with a separate series for
+	every combination of labels. Observing is a binary search and two additions.
+	"""
+
+	kind = "histogram"
+
+	def __init__(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+			buckets: Iterable[float] = DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self.buckets = tuple(sorted(buckets))
+		# Each series is the count of every bucket and +Inf, then the sum.
+		self._series: Dict[Labels, List[float]] = {}
+
+	def observe(self, value: float, *labels: str):
+		series = self._series.get(labels)
+		if series is None:
+			series = self._series[labels] = [0] * (len(self.buckets) + 2)
+		series[bisect_left(self.buckets, value)] += 1
+		series[-1] += value
+
+	def time(self, *labels: str):
+		"""Decorates a function to observe how long each call takes.
+		"""
+
+		def decorate(function: Callable[..., Any]):
+			def timed(*args, **kwargs):
+				started = perf_counter()
+				try:
+					return function(*args, **kwargs)
+				finally:
+					self.observe(perf_counter() - started, *labels)
+			return timed
+		return decorate
+
+	def samples(self) -> Iterator[Sample]:
+		for labels, series in list(self._series.items()):
+			total = 0.0
+			for bound, count in zip(self.buckets + (float("inf"),), series):
+				total += count
+				yield self.name + "_bucket", labels + (_format_value(bound),), total
+			yield self.name + "_sum", labels, series[-1]
+			yield self.name + "_count", labels, total
+
+	def sample_label_names(self, sample_name: str) -> Tuple[str, ...]:
+		if sample_name.endswith("_bucket"):
+			return self.label_names + ("le",)
+		return self.label_names
+
+class Gauge:
+	"""A value read from `function` whenever metrics are rendered. The function
+	returns either a single value, or values by labels.
+	"""
+
+	def __init__(self, name: str, help: str,
+			function: Callable[[], Union[float, Dict[Labels, float]]],
+			label_names: Tuple[str, ...] = (), kind: str = "gauge"):
+		self.name = name
+		self.help = help
+		self.function = function
+		self.label_names = label_names
+		self.kind = kind
+
+	def samples(self) -> Iterator[Sample]:
+		values = self.function()
+		if isinstance(values, dict):
+			for labels, value in values.items():
+				yield self.name, labels, value
+		else:
+			yield self.name, (), values
+
+Metric = Union[Counter, Histogram, Gauge]
+
+class Metrics:
+	"""Every metric of this process, rendered in the Prometheus text format.
+	"""
+
+	def __init__(self):
+		self._metrics: Dict[str, Metric] = {}
+
+	def register(self, metric: Metric) -> Any:
+		if metric.name in self._metrics:
+			raise ValueError(f"Metric {metric.name} is already registered.")
+		self._metrics[metric.name] = metric
+		return metric
+
+	def counter(self, name: str, help: str,
+			label_names: Tuple[str, ...] = ()) -> Counter:
+		return self.register(Counter(name, help, label_names))
+
+	def histogram(self, name: str, help: str, label_names: Tuple[str, ...] = (),
+			buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+		return self.register(Histogram(name, help, label_names, buckets))
+
+	def gauge(self, name: str, help: str,
+			function: Callable[[], Union[float, Dict[Labels, float]]],
+			label_names: Tuple[str, ...] = (), kind: str = "gauge") -> Gauge:
+		return self.register(Gauge(name, help, function, label_names, kind))
+
+	def render(self) -> bytes:
+		lines = []
+		for metric in list(self._metrics.values()):
+			lines.append(f"# HELP {metric.name} {metric.help}")
+			lines.append(f"# TYPE {metric.name} {metric.kind}")
+			for name, labels, value in metric.samples():
+				label_names = metric.sample_label_names(name) \
+					if isinstance(metric, Histogram) else metric.label_names
+				lines.append(name + _format_labels(label_names, labels) + " " +
+					_format_value(value))
+		return ("\n".join(lines) + "\n").encode("utf-8")
+
+metrics = Metrics()
+
+def instrument(obj: Any, histogram: Histogram, names: Iterable[str]):
+	"""Replaces each method of `obj` named in `names` with one that observes its
+	duration in `histogram`, labeled with the method's name.
+	"""
+
+	for name in names:
+		setattr(obj, name, histogram.time(name)(getattr(obj, name)))
+
+_loop_lag = metrics.histogram("event_loop_lag_seconds",
+	"How late the event loop woke up a sleeping greenlet.",
+	buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+_last_loop_lag = [0.0]
+metrics.gauge("event_loop_lag_last_seconds",
+	"The most recently measured event loop lag.", lambda: _last_loop_lag[0])
+
+def _measure_loop_lag(interval: float):
+	while True:
+		started = perf_counter()
+		sleep(interval)
+		lag = max(perf_counter() - started - interval, 0)
+		_loop_lag.observe(lag)
+		_last_loop_lag[0] = lag
+
+def start_loop_lag_monitor(interval: float = 0.5):
+	"""Measures, every `interval` seconds, how long past the interval a sleeping
+	greenlet is woken, which is how long the event loop was kept busy.
+	"""
+
+	spawn(_measure_loop_lag, interval)
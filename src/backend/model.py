@@ -0,0 +1,62 @@
+from inspect import Parameter, signature
+from typing import Any, Callable, Dict, Mapping, Tuple, Type, TypeVar
+
+M = TypeVar("M", bound = "Model")
+
+def _compile_decoder(Class: type) -> Callable[..., Any]:
+	"""Generates a function that makes an instance of `Class` from a document,
+	reading each field straight into its slot without calling `__init__`.
+	Fields missing from the document get the default of the constructor's
+	parameter with the same name.
+	"""
+
+	parameters = signature(Class.__init__).parameters
+	namespace: Dict[str, Any] = {"new": object.__new__, "Class": Class}
+	lines = [
+		"def decode(document, **fields):",
+		"\tobj = new(Class)"
+	]
+	for name in Class.fields:
+		parameter = parameters.get(name)
+		if parameter is None or parameter.default is Parameter.empty:
+			lines.append(f"\tobj.{name} = document[{name!r}]")
+		else:
+			namespace[f"default_{name}"] = parameter.default
+			lines.append(f"\tobj.{name} = document.get({name!r}, default_{name})")
+	lines += [
+		"\tfor name, value in fields.items():",
+		"\t\tsetattr(obj, name, value)",
+		"\treturn obj"
+	]
+
+	exec("\n".join(lines), namespace)
+	return namespace["decode"]
+
+class Model:
+	"""The base of objects that are stored as documents. Subclasses declare the
+	stored attributes in `__slots__`, so instances have no `__dict__`, and the
+	field list and decoder are worked out once per class.
+
+	`to_document` replaces `vars(obj)` for encoding, and `from_document` decodes
+	a document, any mapping, even a `RawBSONDocument`, without building
+	keyword arguments. Fields not in the document, like a message's channel in
+	a page of one channel's messages, can be given as keyword arguments.
+	"""
+
+	__slots__: Tuple[str, ...] = ()
+	fields: Tuple[str, ...] = ()
+	_decode: Callable[..., Any]
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls.fields = tuple(name for Base in reversed(cls.__mro__) \
+			for name in vars(Base).get("__slots__", ()))
+		cls._decode = staticmethod(_compile_decoder(cls))
+
+	@classmethod
+	def from_document(cls: Type[M], document: Mapping[str, Any],
+			**fields: Any) -> M:
+		return cls._decode(document, **fields)
+
+	def to_document(self) -> Dict[str, Any]:
+		return {name: getattr(self, name) for name in self.fields}
@@ -0,0 +1,139 @@
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+from .schema import ensure_indexes, migrate, report_query_plans
+from .storage import Document, Storage
+from .timeline import Position
+
+# The error code of a document that already exists.
+DUPLICATE_KEY = 11000
+
+_no_id = {"_id": False}
+# Pages of messages are always of one channel, so only the rest is fetched.
+_message_page_projection = {
+	"_id": False,
+	"timestamp": True,
+	"author": True,
+	"content": True
+}
+_message_index = "channel_position"
+_newest_first = [("timestamp", -1), ("author", -1)]
+_oldest_first = [("timestamp", 1), ("author", 1)]
+
+class MongoStorage(Storage):
+	"""Stores everything in the MongoDB database `name` at `uri`, one collection
+	per kind of document.
+
+	With `raw_reads`, users and messages are read as `RawBSONDocument`s, which
+	only decode a field once it's used, instead of being decoded into dicts
+	that are thrown away as soon as the object is made.
+	"""
+
+	def __init__(self, uri: Optional[str], name: str, raw_reads: bool = False):
+		self.client: MongoClient = MongoClient(uri)
+		self.database: Database = self.client[name]
+		self._users: Collection = self.database.users
+		self._messages: Collection = self.database.messages
+		if raw_reads:
+			raw = CodecOptions(document_class = RawBSONDocument)
+			self._users = self._users.with_options(codec_options = raw)
+			self._messages = self._messages.with_options(codec_options = raw)
+
+	def bootstrap(self, check_plans: bool = False):
+		migrate(self.database)
+		ensure_indexes(self.database)
+		if check_plans:
+			report_query_plans(self.database)
+
+	def close(self):
+		self.client.close()
+
+	def get_user(self, name: str) -> Optional[Document]:
+		return self._users.find_one({"name": name}, _no_id)
+
+	def get_users(self, names: List[str]) -> List[Document]:
+		return list(self._users.find({"name": {"$in": names}}, _no_id))
+
+	def put_user(self, document: Document):
+		self.database.users.replace_one({"name": document["name"]}, document, True)
+
+	def get_channel(self, community: str, channel: str) -> Optional[Document]:
+		return self.database.channels.find_one({"community": community,
+			"channel": channel}, _no_id)
+
+	def get_channels(self) -> Iterable[Document]:
+		return self.database.channels.find({}, _no_id)
+
+	def put_channel(self, document: Document):
+		self.database.channels.replace_one({"community": document["community"],
+			"channel": document["channel"]}, document, True)
+
+	def get_open_invite(self, code: str) -> Optional[Document]:
+		return self.database.invites.find_one({"code": code, "accepter": None},
+			_no_id)
+
+	def put_invite(self, code: str, document: Document):
+		self.database.invites.replace_one({"code": code, "accepter": None},
+			document)
+
+	def get_session(self, token_hash: str) -> Optional[Document]:
+		raw_session = self.database.sessions.find_one({"token": token_hash}, _no_id)
+		if raw_session is not None:
+			# Dates are read back as naive datetimes in UTC.
+			raw_session["expires"] = raw_session["expires"] \
+				.replace(tzinfo = timezone.utc).timestamp()
+		return raw_session
+
+	def put_session(self, document: Document):
+		# Stored as a date so that the TTL index deletes it once it expires. Dates
+		# are stored in UTC, so the local time zone must not leak into it.
+		self.database.sessions.insert_one({
+			**document,
+			"expires": datetime.fromtimestamp(document["expires"], timezone.utc)
+		})
+
+	def delete_session(self, token_hash: str):
+		self.database.sessions.delete_one({"token": token_hash})
+
+	def get_message(self, community: str, channel: str, timestamp: float,
+			author: str) -> Optional[Document]:
+		return self._messages.find_one({"community": community,
+			"channel": channel, "timestamp": timestamp, "author": author}, _no_id)
+
+	def put_message(self, document: Document):
+		self.database.messages.replace_one({"community": document["community"],
+			"channel": document["channel"], "timestamp": document["timestamp"],
+			"author": document["author"]}, document, True)
+
+	def insert_messages(self, documents: List[Document]) -> \
+			Dict[int, BaseException]:
+		failures: Dict[int, BaseException] = {}
+		try:
+			self.database.messages.insert_many(documents, ordered = False)
+		except BulkWriteError as error:
+			for write_error in error.details.get("writeErrors", []):
+				if write_error.get("code") != DUPLICATE_KEY:
+					failures[write_error["index"]] = error
+		return failures
+
+	def get_messages(self, community: str, channel: str, position: Position,
+			before: bool, limit: int) -> List[Document]:
+		timestamp, author = position
+		compare = "$lt" if before else "$gt"
+		query = {
+			"community": community,
+			"channel": channel,
+			"$or": [
+				{"timestamp": {compare: timestamp}},
+				{"timestamp": timestamp, "author": {compare: author}}
+			]
+		}
+
+		return list(self._messages.find(query, _message_page_projection) \
+			.sort(_newest_first if before else _oldest_first) \
+				.hint(_message_index).limit(limit))
@@ -0,0 +1,210 @@
+from gevent import Greenlet, sleep, spawn, signal_handler
+from gevent.lock import Semaphore
+from gevent.pywsgi import WSGIServer
+from socket import AF_INET, AF_UNIX, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, \
+	socket, socketpair, error as SocketError
+from signal import SIGINT, SIGKILL, SIGTERM
+from json import dumps, loads
+from sys import stderr
+from traceback import print_exc
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import os
+
+drain_timeout = float(os.getenv("WORKER_DRAIN_TIMEOUT", 30))
+restart_delay = 1
+
+_peer: Optional["PeerChannel"] = None
+_peer_handlers: Dict[str, Callable[[Any], None]] = {}
+
+def on_peer_event(kind: str):
+	"""Registers the decorated function as the handler of events of type `kind`
+	broadcast by other workers.
+	"""
+
+	def register(function: Callable[[Any], None]):
+		_peer_handlers[kind] = function
+		return function
+	return register
+
+def broadcast(kind: str, data: Any):
+	"""Sends an event to every other worker. Does nothing unless this process is
+	a pre-forked worker. `data` is encoded with `encode`, which must produce
+	JSON.
+	"""
+
+	if _peer is not None:
+		_peer.send(kind, data)
+
+class PeerChannel:
+	"""A worker's connection to its supervisor, which relays every event written
+	to it to all of the other workers. Events are JSON objects, one per line.
+	Only one greenlet writes to the connection at a time, since gevent refuses
+	concurrent writes to one socket and lines must not be interleaved anyway.
+	"""
+
+	def __init__(self, connection: socket, encode: Callable[[Any], str]):
+		self.connection = connection
+		self.encode = encode
+		self._writing = Semaphore()
+
+	def send(self, kind: str, data: Any):
+		line = '{"kind":' + dumps(kind) + ',"data":' + self.encode(data) + "}\n"
+		with self._writing:
+			try:
+				self.connection.sendall(line.encode("utf-8"))
+			except SocketError:
+				pass
+
+	def receive_forever(self):
+		for line in self.connection.makefile("rb"):
+			event = loads(line)
+			handler = _peer_handlers.get(event.get("kind"))
+			if handler is not None:
+				spawn(handler, event.get("data"))
+
+def _run_worker(listener: socket, connection: socket, application: Any,
+		handler_class: Any, setup: Callable[[], None],
+		teardown: Callable[[], None], encode: Callable[[Any], str]):
+	global _peer
+
+	_peer = PeerChannel(connection, encode)
+	spawn(_peer.receive_forever)
+
+	server = WSGIServer(listener, application, handler_class = handler_class)
+	# Stop accepting, then give open requests some time to finish.
+	signal_handler(SIGTERM, lambda: spawn(server.stop, drain_timeout))
+	signal_handler(SIGINT, lambda: None)
+	# Accept connections while setting up, so that health checks are answered.
+	server.start()
+	setup()
+	server.serve_forever()
+	teardown()
+
+def _describe_exit(status: int) -> str:
+	if os.WIFSIGNALED(status):
+		return f"was killed by signal {os.WTERMSIG(status)}"
+	return f"exited with status {os.WEXITSTATUS(status)}"
+
+class Supervisor:
+	"""Pre-forks `worker_count` workers that all accept connections from one
+	shared listening socket. Workers run `setup` as soon as they accept
+	connections and `teardown` once they have drained. Each worker is connected
+	to the supervisor with a Unix socket, and every event a worker broadcasts is
+	relayed to all of the others. Workers that die are restarted, and on SIGTERM
+	or SIGINT every worker is asked to drain before the supervisor exits.
+	"""
+
+	def __init__(self, address: Tuple[str, int], application: Any,
+			handler_class: Any, worker_count: int, setup: Callable[[], None],
+			teardown: Callable[[], None], encode: Callable[[Any], str]):
+		self.address = address
+		self.application = application
+		self.handler_class = handler_class
+		self.worker_count = worker_count
+		self.setup = setup
+		self.teardown = teardown
+		self.encode = encode
+		self.stopping = False
+		self.workers: Dict[int, socket] = {}
+		# Every worker's relay writes to the others, one at a time per worker.
+		self._writing: Dict[int, Semaphore] = {}
+		self.listener: Optional[socket] = None
+		self._relays: List[Greenlet] = []
+		self._signal_handlers: List[Any] = []
+
+	def start_worker(self):
+		parent_end, child_end = socketpair(AF_UNIX, SOCK_STREAM)
+		pid = os.fork()
+		if pid == 0:
+			# Drop everything that belongs to the supervisor.
+			for handler in self._signal_handlers:
+				handler.cancel()
+			for relay in self._relays:
+				relay.kill(block = False)
+			parent_end.close()
+			for connection in self.workers.values():
+				connection.close()
+			status = 1
+			try:
+				_run_worker(self.listener, child_end, self.application, # type: ignore
+					self.handler_class, self.setup, self.teardown, self.encode)
+				status = 0
+			except BaseException:
+				print_exc()
+			finally:
+				# Only a worker that drained exits cleanly.
+				stderr.flush()
+				os._exit(status)
+
+		child_end.close()
+		self.workers[pid] = parent_end
+		self._writing[pid] = Semaphore()
+		self._relays.append(spawn(self.relay, pid, parent_end))
+
+	def relay(self, pid: int, connection: socket):
+		try:
+			for line in connection.makefile("rb"):
+				for other_pid, other in list(self.workers.items()):
+					writing = self._writing.get(other_pid)
+					if other_pid == pid or writing is None:
+						continue
+					with writing:
+						try:
+							other.sendall(line)
+						except SocketError:
+							pass
+		except SocketError:
+			pass
+
+	def stop(self):
+		self.stopping = True
+		for pid in self.workers:
+			try:
+				os.kill(pid, SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	def serve_forever(self):
+		listener = socket(AF_INET, SOCK_STREAM)
+		listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+		listener.bind(self.address)
+		listener.listen(1024)
+		self.listener = listener
+
+		self._signal_handlers = [
+			signal_handler(SIGTERM, self.stop),
+			signal_handler(SIGINT, self.stop)
+		]
+		for _ in range(self.worker_count):
+			self.start_worker()
+
+		deadline: Optional[float] = None
+		while len(self.workers) > 0:
+			if self.stopping and deadline is None:
+				deadline = monotonic() + drain_timeout + 5
+			if deadline is not None and monotonic() > deadline:
+				for pid in self.workers:
+					try:
+						os.kill(pid, SIGKILL)
+					except ProcessLookupError:
+						pass
+
+			pid, status = os.waitpid(-1, os.WNOHANG)
+			if pid == 0:
+				sleep(0.5)
+				continue
+
+			self._writing.pop(pid, None)
+			connection = self.workers.pop(pid, None)
+			if connection is not None:
+				connection.close()
+			self._relays = [relay for relay in self._relays if not relay.dead]
+			if not self.stopping:
+				print(f"Worker {pid} {_describe_exit(status)}, restarting it.",
+					file = stderr)
+				sleep(restart_delay)
+				if not self.stopping:
+					self.start_worker()
+
+		listener.close()
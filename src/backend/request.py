@@ -0,0 +1,78 @@
+from urllib.parse import parse_qsl, unquote
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+class Headers(Mapping):
+	"""The headers of a request, read straight from its WSGI environ rather than
+	copied out of it. Names are upper case with underscores, as in the environ
+	but without the `HTTP_` prefix, like `ACCEPT_ENCODING`.
+	"""
+
+	__slots__ = ("_environ",)
+
+	def __init__(self, environ: Dict[str, Any]):
+		self._environ = environ
+
+	def __getitem__(self, name: str) -> str:
+		return self._environ["HTTP_" + name]
+
+	def get(self, name: str, default: Any = None) -> Any:
+		return self._environ.get("HTTP_" + name, default)
+
+	def __contains__(self, name: object) -> bool:
+		return isinstance(name, str) and "HTTP_" + name in self._environ
+
+	def __iter__(self) -> Iterator[str]:
+		return (key[5:] for key in self._environ if key.startswith("HTTP_"))
+
+	def __len__(self) -> int:
+		return sum(1 for key in self._environ if key.startswith("HTTP_"))
+
+class MultiDict:
+	"""Query paramaters, which may be repeated. `get` returns the first value of
+	a paramater and `get_all` every value, in order. Iterating yields each
+	paramater and value pair, as `parse_qsl` does.
+	"""
+
+	__slots__ = ("_pairs", "_values")
+
+	def __init__(self, pairs: List[Tuple[str, str]]):
+		self._pairs = pairs
+		self._values: Dict[str, List[str]] = {}
+		for key, val in pairs:
+			values = self._values.get(key)
+			if values is None:
+				self._values[key] = [val]
+			else:
+				values.append(val)
+
+	@staticmethod
+	def parse(query: str) -> "MultiDict":
+		return MultiDict(parse_qsl(query) if query != "" else [])
+
+	def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+		values = self._values.get(key)
+		return values[0] if values is not None else default
+
+	def get_all(self, key: str) -> List[str]:
+		return list(self._values.get(key, ()))
+
+	def __contains__(self, key: str) -> bool:
+		return key in self._values
+
+	def __iter__(self) -> Iterator[Tuple[str, str]]:
+		return iter(self._pairs)
+
+	def __len__(self) -> int:
+		return len(self._pairs)
+
+def split_path(path: str) -> List[str]:
+	"""Splits the path of a request URI into its unquoted segments. The root path
+	has no segments. Only segments that were quoted are unquoted.
+	"""
+
+	if path == "/" or path == "":
+		return []
+	return [
+		unquote(segment) if "%" in segment else segment \
+			for segment in path.split("/")[1:]
+	]
@@ -0,0 +1,141 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from sys import stderr
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Every index the queries in `database.py` rely on, by collection.
+INDEXES: Dict[str, List[IndexModel]] = {
+	"users": [
+		IndexModel([("name", ASCENDING)], name = "name", unique = True)
+	],
+	"messages": [
+		IndexModel([("community", ASCENDING), ("channel", ASCENDING),
+			("timestamp", ASCENDING), ("author", ASCENDING)],
+			name = "channel_position", unique = True)
+	],
+	"channels": [
+		IndexModel([("community", ASCENDING), ("channel", ASCENDING)],
+			name = "community_channel", unique = True)
+	],
+	"invites": [
+		IndexModel([("code", ASCENDING), ("accepter", ASCENDING)],
+			name = "code_accepter")
+	],
+	"sessions": [
+		IndexModel([("token", ASCENDING)], name = "token", unique = True),
+		# Lets the database delete sessions once they expire.
+		IndexModel([("expires", ASCENDING)], name = "expires",
+			expireAfterSeconds = 0)
+	]
+}
+
+# Every query shape used in `database.py`, as a collection, a description, a
+# filter and an optional sort.
+QueryShape = Tuple[str, str, Dict[str, Any], Optional[List[Tuple[str, int]]]]
+QUERY_SHAPES: List[QueryShape] = [
+	("users", "user by name", {"name": "_"}, None),
+	("users", "users by names", {"name": {"$in": ["_", "__"]}}, None),
+	("messages", "message by position",
+		{"community": "_", "channel": "_", "timestamp": 0.0, "author": "_"},
+		None),
+	("messages", "messages before position",
+		{"community": "_", "channel": "_", "$or": [
+			{"timestamp": {"$lt": 0.0}},
+			{"timestamp": 0.0, "author": {"$lt": "_"}}
+		]},
+		[("timestamp", DESCENDING), ("author", DESCENDING)]),
+	("messages", "messages after position",
+		{"community": "_", "channel": "_", "$or": [
+			{"timestamp": {"$gt": 0.0}},
+			{"timestamp": 0.0, "author": {"$gt": "_"}}
+		]},
+		[("timestamp", ASCENDING), ("author", ASCENDING)]),
+	("messages", "newest messages", {"community": "_", "channel": "_"},
+		[("timestamp", DESCENDING), ("author", DESCENDING)]),
+	("channels", "channel by id", {"community": "_", "channel": "_"}, None),
+	("invites", "open invite by code", {"code": "_", "accepter": None}, None),
+	("sessions", "session by token", {"token": "_"}, None)
+]
+
+# Indexes that were replaced, by collection.
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+	"messages": ["timestamp", "channel_timestamp"]
+}
+
+def migrate(database: Database):
+	"""Brings documents written by older versions up to date. Messages from
+	before channels existed are moved to the default channel, which is created
+	if it doesn't exist.
+
+	Pre-forked workers all migrate at once, so anything another worker did first
+	is treated as done.
+	"""
+
+	database.messages.update_many({"community": {"$exists": False}},
+		{"$set": {"community": "_", "channel": "_"}})
+	try:
+		database.channels.update_one({"community": "_", "channel": "_"},
+			{"$setOnInsert": {"community": "_", "channel": "_", "about": None}},
+			upsert = True)
+	except DuplicateKeyError:
+		pass
+
+	for collection, names in OBSOLETE_INDEXES.items():
+		existing = database[collection].index_information()
+		for name in names:
+			if name in existing:
+				try:
+					database[collection].drop_index(name)
+				except OperationFailure as error:
+					# 27 is IndexNotFound, it was dropped by another worker.
+					if error.code != 27:
+						raise
+
+def ensure_indexes(database: Database):
+	"""Creates every index in `INDEXES` that doesn't exist yet.
+	"""
+
+	for collection, indexes in INDEXES.items():
+		database[collection].create_indexes(indexes)
+
+def _plan_stages(plan: Dict[str, Any]) -> Iterator[str]:
+	yield plan.get("stage", "")
+	if "inputStage" in plan:
+		yield from _plan_stages(plan["inputStage"])
+	for stage in plan.get("inputStages", []):
+		yield from _plan_stages(stage)
+	# Newer servers wrap the classic plan in a query plan.
+	if "queryPlan" in plan:
+		yield from _plan_stages(plan["queryPlan"])
+
+def check_query_plans(database: Database) -> List[str]:
+	"""Explains every query in `QUERY_SHAPES`, and returns a warning for each one
+	that scans a whole collection or sorts in memory.
+	"""
+
+	warnings = []
+	for collection, description, query, sort in QUERY_SHAPES:
+		cursor = database[collection].find(query).limit(50)
+		if sort is not None:
+			cursor = cursor.sort(sort)
+		plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+		stages = set(_plan_stages(plan))
+
+		if "COLLSCAN" in stages:
+			warnings.append(f"Query for {description} in {collection} scans the " +
+				"whole collection.")
+		elif "SORT" in stages:
+			warnings.append(f"Query for {description} in {collection} sorts in " +
+				"memory.")
+	return warnings
+
+def report_query_plans(database: Database):
+	for warning in check_query_plans(database):
+		print(f"Warning: {warning}", file = stderr)
+
+if __name__ == "__main__":
+	from .database import get_storage, open_database
+
+	open_database()
+	get_storage().bootstrap(check_plans = True)
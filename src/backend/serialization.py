@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from math import isfinite
+from os import getenv
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+from .timeline import Position
+from .utilities import dump_json, load_json
+
+class FragmentCache:
+	"""Caches the encoded JSON of objects, so that objects which rarely or never
+	change are only encoded once. Only registered classes are cached, keyed by
+	their unique id, and the owner of the objects is responsible for calling
+	`invalidate` when one changes. At most `max_entries` fragments are kept,
+	dropping the least recently used first.
+	"""
+
+	def __init__(self, max_entries: int = 20000):
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._fragments: "OrderedDict[Tuple[type, Hashable], bytes]" = \
+			OrderedDict()
+		self._id_names: Dict[type, str] = {}
+
+	def register(self, Class: type, id_name: str):
+		"""Caches fragments of `Class`, using the attribute `id_name` as the key.
+		"""
+
+		self._id_names[Class] = id_name
+
+	def fragment(self, obj: Any) -> bytes:
+		"""Gets the encoded JSON of `obj`.
+		"""
+
+		id_name = self._id_names.get(type(obj))
+		if id_name is None:
+			return dump_json(obj, indent=None).encode("utf-8")
+
+		key = (type(obj), getattr(obj, id_name))
+		fragment = self._fragments.get(key)
+		if fragment is not None:
+			self._fragments.move_to_end(key)
+			self.hits += 1
+			return fragment
+
+		self.misses += 1
+		fragment = dump_json(obj, indent=None).encode("utf-8")
+		self._fragments[key] = fragment
+		if len(self._fragments) > self.max_entries:
+			self._fragments.popitem(last = False)
+		return fragment
+
+	def invalidate(self, obj: Any):
+		id_name = self._id_names.get(type(obj))
+		if id_name is not None:
+			self.discard(type(obj), getattr(obj, id_name))
+
+	def discard(self, Class: type, id_attr: Hashable):
+		"""Removes the fragment of the `Class` object with the unique id `id_attr`,
+		for when only the id of a changed object is known.
+		"""
+
+		self._fragments.pop((Class, id_attr), None)
+
+	def stats(self) -> Dict[str, int]:
+		return {
+			"entries": len(self._fragments),
+			"max_entries": self.max_entries,
+			"hits": self.hits,
+			"misses": self.misses
+		}
+
+fragments = FragmentCache(int(getenv("JSON_FRAGMENT_CACHE_SIZE", 20000)))
+
+def join_fragments(parts: Iterable[bytes]) -> bytes:
+	return b"[" + b",".join(parts) + b"]"
+
+def render_page(users: Iterable[Any], messages: Iterable[Any],
+		cursors: bytes = b"") -> bytes:
+	"""Encodes a messages response body by splicing together the cached
+	fragments of `users` and `messages`, followed by `cursors` from
+	`render_cursors` if given.
+	"""
+
+	return b'{"users":' + join_fragments(map(fragments.fragment, users)) + \
+		b',"messages":' + join_fragments(map(fragments.fragment, messages)) + \
+		cursors + b"}"
+
+def encode_cursor(position: Position, before: bool) -> str:
+	"""Encodes a position in a channel, and whether to page before or after it,
+	as an opaque URL safe cursor.
+	"""
+
+	data = dump_json([position[0], position[1], before], indent=None)
+	return urlsafe_b64encode(data.encode("utf-8")).rstrip(b"=").decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[Position, bool]:
+	"""Decodes a cursor made by `encode_cursor` into its position and direction.
+	Raises ValueError if the cursor is malformed.
+	"""
+
+	try:
+		data = load_json(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+	except (TypeError, ValueError):
+		raise ValueError("Malformed cursor.")
+
+	if type(data) is not list or len(data) != 3 or \
+			type(data[0]) not in (int, float) or not isfinite(data[0]) or \
+			type(data[1]) is not str or type(data[2]) is not bool:
+		raise ValueError("Malformed cursor.")
+	return (float(data[0]), data[1]), data[2]
+
+def render_cursors(next_cursor: Optional[str], prev_cursor: Optional[str]) -> \
+		bytes:
+	"""Encodes the `next` and `prev` members of a messages response body, to be
+	spliced in by `render_page` or `render_items`.
+	"""
+
+	return (',"next":' + dump_json(next_cursor, indent=None) + ',"prev":' + \
+		dump_json(prev_cursor, indent=None)).encode("utf-8")
@@ -0,0 +1,126 @@
+from hashlib import sha256
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from .cache import NegativeCache
+from .storage import Storage
+
+class Session:
+	__slots__ = ("user", "expires")
+
+	def __init__(self, user: Any, expires: float):
+		self.user = user
+		self.expires = expires
+
+def hash_token(token: str) -> str:
+	return sha256(token.encode("utf-8")).hexdigest()
+
+class SessionStore:
+	"""Maps opaque bearer tokens to users. Tokens are resolved from memory in
+	constant time, and are also stored in `storage`, by hash only, so that they
+	survive restarts. A token missing from memory is looked up there once,
+	and its user loaded with `get_user`. Tokens that aren't there either are
+	remembered as unknown for `unknown_ttl` seconds, so that garbage tokens don't
+	query the storage on every request.
+
+	Sessions last `ttl` seconds from when they were created.
+	"""
+
+	def __init__(self, storage: Storage,
+			get_user: Callable[[str], Optional[Any]], ttl: float,
+			unknown_ttl: float = 60, max_unknown: int = 10000):
+		self.storage = storage
+		self.get_user = get_user
+		self.ttl = ttl
+		# Tokens are random, so one that was unknown won't be created later.
+		self.unknown = NegativeCache(max_unknown, unknown_ttl)
+		self._sessions: Dict[str, Session] = {}
+		self._tokens_by_name: Dict[str, Set[str]] = {}
+		self._lock = Lock()
+
+	def _remember(self, token: str, session: Session):
+		with self._lock:
+			self._sessions[token] = session
+			self._tokens_by_name.setdefault(session.user.name, set()).add(token)
+
+	def forget(self, token: str) -> Optional[Session]:
+		"""Removes a session from memory only.
+		"""
+
+		with self._lock:
+			session = self._sessions.pop(token, None)
+			if session is not None:
+				tokens = self._tokens_by_name.get(session.user.name)
+				if tokens is not None:
+					tokens.discard(token)
+					if len(tokens) == 0:
+						del self._tokens_by_name[session.user.name]
+			return session
+
+	def create(self, user: Any) -> Tuple[str, float]:
+		"""Creates a new session for `user`, returning its token and when it
+		expires.
+		"""
+
+		token = token_urlsafe(32)
+		expires = time() + self.ttl
+		self.storage.put_session({
+			"token": hash_token(token),
+			"name": user.name,
+			"expires": expires
+		})
+		self._remember(token, Session(user, expires))
+		return token, expires
+
+	def resolve(self, token: str) -> Optional[Any]:
+		"""Gets the user a token belongs to, or None if the token is unknown or has
+		expired.
+		"""
+
+		now = time()
+		session = self._sessions.get(token)
+		if session is None:
+			token_hash = hash_token(token)
+			if token_hash in self.unknown:
+				return None
+			raw_session = self.storage.get_session(token_hash)
+			if raw_session is None:
+				self.unknown.add(token_hash)
+				return None
+			user = self.get_user(raw_session["name"])
+			if user is None:
+				return None
+			session = Session(user, raw_session["expires"])
+			self._remember(token, session)
+
+		if now >= session.expires:
+			self.revoke(token)
+			return None
+		return session.user
+
+	def revoke(self, token: str):
+		self.forget(token)
+		self.storage.delete_session(hash_token(token))
+
+	def update_user(self, user: Any):
+		"""Points every session of the user with the same name at `user`.
+		"""
+
+		with self._lock:
+			for token in self._tokens_by_name.get(user.name, ()):
+				self._sessions[token].user = user
+
+	def expire(self):
+		"""Forgets every expired session. Expired sessions left in the storage are
+		deleted the next time they are used.
+		"""
+
+		now = time()
+		expired = [
+			token for token, session in list(self._sessions.items()) \
+				if now >= session.expires
+		]
+		for token in expired:
+			self.forget(token)
+		self.unknown.expire()
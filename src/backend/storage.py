@@ -0,0 +1,126 @@
+from os import getenv
+from typing import Any, Dict, Iterable, List, Optional, Type
+from .timeline import Position
+
+Document = Dict[str, Any]
+
+class Storage:
+	"""Where everything in `database.py` is persisted. Documents are plain dicts
+	holding an object's attributes, without any id added by the storage. The
+	documents of users and messages that are read may instead be read-only
+	mappings, like a `RawBSONDocument`, and may have extra fields.
+
+	Users are keyed by name, channels by community and channel, invites by code,
+	sessions by token hash and messages by community, channel and position.
+	Only one invite per code is open at a time, the one without an accepter.
+
+	Storages that are `shared` can be used by several processes at once.
+	"""
+
+	shared = True
+
+	def bootstrap(self, check_plans: bool = False):
+		"""Prepares the storage for serving, and if `check_plans` is set warns
+		about anything that will be slow.
+		"""
+
+	def expire(self):
+		"""Runs periodic maintenance, such as dropping expired sessions.
+		"""
+
+	def close(self):
+		pass
+
+	def get_user(self, name: str) -> Optional[Document]:
+		raise NotImplementedError()
+
+	def get_users(self, names: List[str]) -> List[Document]:
+		"""Gets every user named in `names` that exists, in any order.
+		"""
+
+		raise NotImplementedError()
+
+	def put_user(self, document: Document):
+		raise NotImplementedError()
+
+	def get_channel(self, community: str, channel: str) -> Optional[Document]:
+		raise NotImplementedError()
+
+	def get_channels(self) -> Iterable[Document]:
+		raise NotImplementedError()
+
+	def put_channel(self, document: Document):
+		raise NotImplementedError()
+
+	def get_open_invite(self, code: str) -> Optional[Document]:
+		raise NotImplementedError()
+
+	def put_invite(self, code: str, document: Document):
+		"""Replaces the open invite with the code `code`.
+		"""
+
+		raise NotImplementedError()
+
+	def get_session(self, token_hash: str) -> Optional[Document]:
+		raise NotImplementedError()
+
+	def put_session(self, document: Document):
+		"""Stores a session, which has a `token` hash, a user `name` and the
+		timestamp it `expires` at.
+		"""
+
+		raise NotImplementedError()
+
+	def delete_session(self, token_hash: str):
+		raise NotImplementedError()
+
+	def get_message(self, community: str, channel: str, timestamp: float,
+			author: str) -> Optional[Document]:
+		raise NotImplementedError()
+
+	def put_message(self, document: Document):
+		raise NotImplementedError()
+
+	def insert_messages(self, documents: List[Document]) -> \
+			Dict[int, BaseException]:
+		"""Inserts new messages in one go, returning the error of each document
+		that failed by its index. Messages that already exist count as inserted.
+		"""
+
+		raise NotImplementedError()
+
+	def get_messages(self, community: str, channel: str, position: Position,
+			before: bool, limit: int) -> List[Document]:
+		"""Gets up to `limit` messages of a channel before or after `position`,
+		newest first when going `before` and oldest first otherwise. Only the
+		timestamp, author and content of each message are needed.
+		"""
+
+		raise NotImplementedError()
+
+def storage_class() -> Type[Storage]:
+	"""Gets the class of the storage selected by the `STORAGE` environment
+	variable, either "mongo", the default, or "local" for the embedded storage,
+	without opening it.
+	"""
+
+	kind = getenv("STORAGE", "mongo")
+	if kind == "mongo":
+		from .mongostorage import MongoStorage
+		return MongoStorage
+	if kind == "local":
+		from .localstorage import LocalStorage
+		return LocalStorage
+	raise ValueError(f"Unknown storage {kind!r}.")
+
+def open_storage() -> Storage:
+	"""Opens the storage selected by the `STORAGE` environment variable. The
+	local storage is kept in `LOCAL_STORAGE_PATH`.
+	"""
+
+	Class: Any = storage_class()
+	if getenv("STORAGE", "mongo") == "mongo":
+		return Class(getenv("MONGO_DB_CONNECT"), "project-dark",
+			getenv("MONGO_RAW_BSON", "").lower() in ("1", "true"))
+	return Class(getenv("LOCAL_STORAGE_PATH", "data"),
+		float(getenv("LOCAL_STORAGE_COMPACT_RATIO", 0.5)))
@@ -0,0 +1,148 @@
+from bisect import bisect_left, bisect_right
+from itertools import count
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Where a message sits in a channel, its timestamp with the author as a
+# tiebreaker for messages posted at the same time.
+Position = Tuple[float, str]
+
+# Shared by every timeline, so a recreated timeline never repeats a version.
+# Versions only differ within a process, forked workers count from where the
+# supervisor was.
+_versions = count(1)
+
+class Timeline:
+	"""A bounded, position ordered buffer of the most recent messages of a
+	channel. The buffer holds every message at or after `floor`, so any query
+	that only touches that range is answered with a binary search instead of a
+	database query. Once the buffer grows past `capacity` the oldest messages are
+	dropped and `floor` moves forward. A `floor` of None means the buffer holds
+	every message there is.
+
+	Queries that reach past `floor` return None, meaning the caller has to ask
+	the database instead. Hits and misses are counted for `stats`.
+
+	Messages inserted before the timeline is warmed are kept and merged into the
+	warmed buffer, so nothing posted while warming is lost.
+
+	`version` changes every time the timeline is warmed or a message is inserted,
+	even one older than the buffer, so it tells whether any page of the channel
+	could have changed.
+	"""
+
+	def __init__(self, capacity: int = 5000):
+		self.capacity = capacity
+		self.floor: Optional[Position] = None
+		# Nothing is covered until the timeline is warmed.
+		self.warmed = False
+		self.hits = 0
+		self.misses = 0
+		self.version = next(_versions)
+		self._positions: List[Position] = []
+		self._messages: List[Any] = []
+
+	def warm(self, newest_messages: Iterable[Any]):
+		"""Replaces the buffer with `newest_messages`, which must be the newest
+		messages in the database in any order, and at most `capacity` of them. If
+		fewer than `capacity` are given they are assumed to be every message there
+		is.
+		"""
+
+		loaded = {message.position: message for message in newest_messages}
+		floor = None if len(loaded) < self.capacity else min(loaded)
+		# Inserted messages are newer than anything loaded, or the same ones.
+		loaded.update(zip(self._positions, self._messages))
+
+		self._positions = sorted(loaded)
+		self._messages = [loaded[position] for position in self._positions]
+		self.floor = floor
+		self.warmed = True
+		self.version = next(_versions)
+
+	def insert(self, message: Any):
+		"""Adds a message, replacing the message at the same position if there is
+		one. New messages are almost always the newest, which makes this an append.
+		"""
+
+		position = message.position
+		self.version = next(_versions)
+		if self.warmed and self.floor is not None and position < self.floor:
+			# Older than what the buffer covers, the database will have it.
+			return
+
+		if len(self._positions) == 0 or position > self._positions[-1]:
+			self._positions.append(position)
+			self._messages.append(message)
+		else:
+			ind = bisect_left(self._positions, position)
+			if ind < len(self._positions) and self._positions[ind] == position:
+				self._messages[ind] = message
+			else:
+				self._positions.insert(ind, position)
+				self._messages.insert(ind, message)
+
+		# Trim in batches so that appending stays amortized O(1).
+		if len(self._positions) > self.capacity + self.capacity // 4 and \
+				self.warmed:
+			excess = len(self._positions) - self.capacity
+			del self._positions[:excess]
+			del self._messages[:excess]
+			self.floor = self._positions[0]
+
+	def query(self, position: Position, before: bool, limit: int) -> \
+			Optional[List[Any]]:
+		"""Gets up to `limit` messages before or after `position`, newest first
+		when going `before` and oldest first otherwise, matching `get_messages`.
+		Returns None if the buffer can't answer the query.
+		"""
+
+		if not self.warmed:
+			self.misses += 1
+			return None
+
+		if before:
+			end = bisect_left(self._positions, position)
+			if end < limit and self.floor is not None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			return self._messages[max(end - limit, 0):end][::-1]
+		else:
+			if self.floor is not None and position < self.floor:
+				self.misses += 1
+				return None
+			start = bisect_right(self._positions, position)
+			self.hits += 1
+			return self._messages[start:start + limit]
+
+	@property
+	def latest(self) -> Optional[Position]:
+		"""The position of the newest buffered message.
+		"""
+
+		return self._positions[-1] if len(self._positions) > 0 else None
+
+	def stats(self) -> Dict[str, Any]:
+		queries = self.hits + self.misses
+		return {
+			"entries": len(self._messages),
+			"capacity": self.capacity,
+			"hits": self.hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / queries if queries > 0 else 0.0
+		}
+
+	def __len__(self) -> int:
+		return len(self._messages)
+
+def position_before(timestamp: float) -> Position:
+	"""The position just before every message posted at `timestamp`.
+	"""
+
+	return (timestamp, "")
+
+def position_after(timestamp: float) -> Position:
+	"""The position just after every message posted at `timestamp`.
+	"""
+
+	return (timestamp, "\U0010ffff")
@@ -2,13 +2,27 @@ from . import HTTPJob
 from json import JSONEncoder, dumps, loads, JSONDecodeError
 from functools import reduce
 from mimetypes import guess_type as get_type
+from gzip import compress as gzip_compress
+from hashlib import sha1
+from email.utils import formatdate, parsedate_to_datetime
+from re import compile as regex_compile
+from os import path as ospath
 from typing import Any, Callable, Dict, Generic, Iterable, List, Optional, Tuple, \
 	TypeVar, Union, overload
 
+try:
+	from brotli import compress as brotli_compress
+except ImportError:
+	brotli_compress = None
+
 T = TypeVar("T")
 
 JSONDecodeError = JSONDecodeError
 
+# Matches names like "app.3f9a2c1b.js", which change whenever their content does.
+fingerprint_regex = regex_compile(r"[.-][0-9a-fA-F]{8,}\.[^.]+$")
+range_regex = regex_compile(r"^bytes=(\d*)-(\d*)$")
+
 class DunderJSONEncoder(JSONEncoder):
 	"""A JSON Encoder that treats objects with a __to_json__ method specially,
 	and instead encodes the representation of the object using lists and
@@ -64,25 +78,135 @@ class Endpoint:
 		]
 		self._handler(job, *parameters)
 
+	def handle(self, job: HTTPJob, parameters: List[str]):
+		"""Calls the handler with parameters that were already extracted from the
+		path, typically by a `Router`.
+		"""
+
+		self._handler(job, *parameters)
+
+	@property
+	def route(self) -> str:
+		"""The endpoint's path, with parameters written as `{}`.
+		"""
+
+		return "/" + "/".join(
+			"{}" if part is None else part for part in self.expression)
+
+	def __repr__(self) -> str:
+		return "<endpoint " + self.route + ">"
+
+class RouteNode:
+	"""A node of a `Router`'s segment trie. Literal segments are looked up in
+	`literals`, and any segment that doesn't match a literal falls back to the
+	`wildcard` child.
+	"""
+
+	__slots__ = ("literals", "wildcard", "endpoint")
+
+	def __init__(self):
+		self.literals: Dict[str, RouteNode] = {}
+		self.wildcard: Optional[RouteNode] = None
+		self.endpoint: Optional[Endpoint] = None
+
+class AmbiguousRouteError(ValueError):
+	pass
+
+class Router:
+	"""A route table compiled once from a collection of endpoints. Paths are
+	resolved by walking a trie of path segments, capturing wildcard segments as
+	parameters on the way down, so resolving costs one dictionary lookup per
+	segment no matter how many endpoints there are. Literal segments take
+	precedence over wildcards.
+
+	Two endpoints with the same expression can never both be reached, so they
+	raise an `AmbiguousRouteError` when the table is built.
+	"""
+
+	def __init__(self, endpoints: Iterable[Endpoint]):
+		self._root = RouteNode()
+		for endpoint in endpoints:
+			self.add(endpoint)
+
+	def add(self, endpoint: Endpoint):
+		node = self._root
+		for part in endpoint.expression:
+			if part is None:
+				if node.wildcard is None:
+					node.wildcard = RouteNode()
+				node = node.wildcard
+			else:
+				next_node = node.literals.get(part)
+				if next_node is None:
+					next_node = node.literals[part] = RouteNode()
+				node = next_node
+
+		if node.endpoint is not None:
+			raise AmbiguousRouteError(
+				f"{endpoint!r} conflicts with {node.endpoint!r}.")
+		node.endpoint = endpoint
+
+	def resolve(self, path: List[str]) -> \
+			Optional[Tuple[Endpoint, List[str]]]:
+		"""Finds the endpoint for `path`, returning it along with the segments
+		captured by its wildcards, or None if no endpoint matches.
+		"""
+
+		return self._resolve(self._root, path, 0, [])
+
+	def _resolve(self, node: RouteNode, path: List[str], ind: int,
+			parameters: List[str]) -> Optional[Tuple[Endpoint, List[str]]]:
+		while ind < len(path):
+			part = path[ind]
+			literal = node.literals.get(part)
+			if literal is not None:
+				if node.wildcard is not None:
+					# Only branch when both could match, so the common case never
+					# recurses.
+					found = self._resolve(literal, path, ind + 1, parameters.copy())
+					if found is not None:
+						return found
+				else:
+					node = literal
+					ind += 1
+					continue
+
+			if node.wildcard is None:
+				return None
+			parameters.append(part)
+			node = node.wildcard
+			ind += 1
+
+		return None if node.endpoint is None else (node.endpoint, parameters)
+
 class HTTPHeadJob(HTTPJob):
 	"""Internal class used for desguising a HEAD request as a GET request. Used by
 	the `generate_methods` function.
 	"""
 
+	__slots__ = ("_old_job",)
+
 	def __init__(self, old_job: HTTPJob):
+		self._request = old_job._request
+		self._headers = old_job._headers
+		self._path = old_job._path
+		self._query = old_job._query
 		self.method = "GET"
-		self.uri = old_job.uri
-		self.headers = old_job.headers
+		self.body = old_job.body
 		self._old_job = old_job
 
+	@property
+	def disconnected(self):
+		return self._old_job.disconnected
+
 	def write_head(self, status: Union[int, str], headers: Dict[str, str] = {}):
 		self._old_job.write_head(status, headers)
 		self._old_job.close_body()
 
-	def write_body(self):
+	def write_body(self, body: Any = None):
 		pass
 
-	def close_body(self):
+	def close_body(self, body: Any = None):
 		pass
 
 @overload
@@ -98,6 +222,15 @@ def try_except(success: Callable[..., T],
 def join(lst: Iterable[Any], glue: str = ", "):
 	return try_except(lambda: reduce(lambda a, b: f"{a}{glue}{b}", lst), "")
 
+def matches_etag(if_none_match: str, etags: Iterable[str]) -> bool:
+	"""Whether an `If-None-Match` header matches any of `etags`, comparing weakly
+	as the header requires.
+	"""
+
+	tags = {tag.strip() for tag in if_none_match.split(",")}
+	tags |= {tag[2:] for tag in tags if tag.startswith("W/")}
+	return "*" in tags or any(etag in tags for etag in etags)
+
 def generate_endpoint(expression: Union[str, List[Optional[str]]],
 		methods: Dict[str, Optional[Callable[..., None]]],
 		cors_methods: List[str] = [], cors_origins: List[str] = [],
@@ -113,7 +246,7 @@ def generate_endpoint(expression: Union[str, List[Optional[str]]],
 
 	def perform_head(job: HTTPJob, *args, **kwargs):
 		new_job = HTTPHeadJob(job)
-		methods.get("GET")(new_job)
+		methods.get("GET")(new_job, *args, **kwargs)
 
 	def preform_options(job: HTTPJob, *args, **kwargs):
 		job.close_head(204, headers_options)
@@ -131,29 +264,210 @@ def generate_endpoint(expression: Union[str, List[Optional[str]]],
 			method(job, *args, **kwargs)
 	return Endpoint(expression, on_request)
 
+class StaticContent:
+	"""Static content prepared once for serving: every encoding it can be sent
+	with, along with its validators and caching policy.
+	"""
+
+	def __init__(self, content: bytes, mime: str, modified: Optional[float],
+			immutable: bool):
+		self.mime = mime
+		self.length = len(content)
+		digest = sha1(content).hexdigest()[:20]
+
+		# Only keep compressed variants that are actually smaller.
+		self.variants: Dict[str, Tuple[bytes, str]] = {
+			"identity": (content, f'"{digest}"')
+		}
+		compressors = [("gzip", lambda data: gzip_compress(data, 9, mtime = 0))]
+		if brotli_compress is not None:
+			compressors.insert(0, ("br", brotli_compress))
+		for encoding, compress in compressors:
+			compressed = compress(content)
+			if len(compressed) < len(content):
+				self.variants[encoding] = (compressed, f'"{digest}-{encoding}"')
+
+		self.etags = {etag for _, etag in self.variants.values()}
+		self.modified = None if modified is None else int(modified)
+		self.last_modified = None if modified is None \
+			else formatdate(modified, usegmt = True)
+		self.cache_control = "public, max-age=31536000, immutable" if immutable \
+			else "no-cache"
+
+	def is_not_modified(self, headers: Dict[str, str]):
+		if_none_match = headers.get("IF_NONE_MATCH")
+		if if_none_match is not None:
+			return matches_etag(if_none_match, self.etags)
+
+		if_modified_since = headers.get("IF_MODIFIED_SINCE")
+		if if_modified_since is not None and self.modified is not None:
+			try:
+				return self.modified <= \
+					int(parsedate_to_datetime(if_modified_since).timestamp())
+			except (TypeError, ValueError):
+				return False
+		return False
+
+	def negotiate(self, accept_encoding: str) -> str:
+		"""Picks the encoding to send, preferring the client's highest quality
+		encoding and then the smallest variant.
+		"""
+
+		qualities: Dict[str, float] = {}
+		for part in accept_encoding.split(","):
+			name, _, params = part.strip().partition(";")
+			quality = 1.0
+			params = params.strip()
+			if params.startswith("q="):
+				quality = try_except(lambda: float(params[2:]), 0.0)
+			qualities[name.strip().lower()] = quality
+
+		best = "identity"
+		best_key = (qualities.get("identity", qualities.get("*", 1.0)), 0)
+		for encoding, (data, _) in self.variants.items():
+			if encoding == "identity":
+				continue
+			quality = qualities.get(encoding, qualities.get("*", 0.0))
+			key = (quality, self.length - len(data))
+			if quality > 0 and key > best_key:
+				best, best_key = encoding, key
+		return best
+
+	def byte_range(self, headers: Dict[str, str]) -> \
+			Optional[Union[Tuple[int, int], bool]]:
+		"""Gets the inclusive byte range requested with the `Range` header, None
+		when the whole content should be sent, or False if the range can't be
+		satisfied.
+		"""
+
+		range_header = headers.get("RANGE")
+		if range_header is None:
+			return None
+		if_range = headers.get("IF_RANGE")
+		if if_range is not None and if_range not in self.etags and \
+				if_range != self.last_modified:
+			return None
+
+		# Multiple ranges aren't supported, the full content is sent instead.
+		range_match = range_regex.match(range_header.strip())
+		if range_match is None:
+			return None
+		start_raw, end_raw = range_match[1], range_match[2]
+		if start_raw == "" and end_raw == "":
+			return None
+
+		if start_raw == "":
+			start = max(self.length - int(end_raw), 0)
+			end = self.length - 1
+		else:
+			start = int(start_raw)
+			end = self.length - 1 if end_raw == "" \
+				else min(int(end_raw), self.length - 1)
+		if start > end or start >= self.length:
+			return False
+		return start, end
+
+	def serve(self, job: HTTPJob):
+		headers = {
+			"Cache-Control": self.cache_control,
+			"Vary": "Accept-Encoding"
+		}
+		if self.last_modified is not None:
+			headers["Last-Modified"] = self.last_modified
+
+		if self.is_not_modified(job.headers):
+			headers["ETag"] = self.variants["identity"][1]
+			return job.close_head(304, headers)
+
+		headers["Content-Type"] = self.mime
+		headers["Accept-Ranges"] = "bytes"
+
+		byte_range = self.byte_range(job.headers)
+		if byte_range is False:
+			headers["Content-Range"] = f"bytes */{self.length}"
+			headers["Content-Length"] = "0"
+			return job.close_head(416, headers)
+		elif byte_range is not None:
+			# Ranges always refer to the uncompressed content.
+			start, end = byte_range # type: ignore
+			content, etag = self.variants["identity"]
+			headers["ETag"] = etag
+			headers["Content-Range"] = f"bytes {start}-{end}/{self.length}"
+			headers["Content-Length"] = str(end - start + 1)
+			job.write_head(206, headers)
+			return job.close_body(content[start:end + 1])
+
+		encoding = self.negotiate(job.headers.get("ACCEPT_ENCODING", ""))
+		content, etag = self.variants[encoding]
+		headers["ETag"] = etag
+		headers["Content-Length"] = str(len(content))
+		if encoding != "identity":
+			headers["Content-Encoding"] = encoding
+		job.write_head(200, headers)
+		job.close_body(content)
+
+class LazyStaticContent:
+	"""`StaticContent` that is only loaded and compressed once it is first
+	served, or once `prepare_static_content` is called, so that none of it slows
+	down importing the server.
+	"""
+
+	def __init__(self, load: Callable[[], StaticContent]):
+		self._load = load
+		self._content: Optional[StaticContent] = None
+		lazy_static_content.append(self)
+
+	@property
+	def content(self) -> StaticContent:
+		if self._content is None:
+			self._content = self._load()
+		return self._content
+
+	def serve(self, job: HTTPJob):
+		self.content.serve(job)
+
+lazy_static_content: List[LazyStaticContent] = []
+
+def prepare_static_content():
+	"""Loads every static content that hasn't been served yet.
+	"""
+
+	for static in lazy_static_content:
+		static.content
+
 def static_routes(paths: List[str], content: Optional[Union[bytes, str]] = None,
 		file: Optional[str] = None, mime: Optional[Tuple[str, str]] = None):
+	"""Creates endpoints serving static content at `paths`, from either `content`
+	or a `file`. Compressed variants, validators and caching headers are
+	prepared once, the first time they are needed. Files with a fingerprint in
+	their name are cached by clients for a year, everything else is revalidated
+	on every use.
+	"""
+
 	if content is None and file is None:
 		raise TypeError("Expected content xor file to be present but neither were.")
 	elif content is not None and file is not None:
 		raise TypeError("Expected content xor file to be present but both were.")
-	the_content: Optional[Union[str, bytes]] = open(file, "rb").read() \
-		if file is not None else content
-	the_mime = mime if mime is not None else get_type(file) \
-		if file is not None else None
 
-	def route(job: HTTPJob):
+	def load() -> StaticContent:
+		the_content: Optional[Union[str, bytes]] = open(file, "rb").read() \
+			if file is not None else content
+		the_mime = mime if mime is not None else get_type(file) \
+			if file is not None else None
+
 		assert the_content is not None
-		content_length = len(the_content)
-		job.write_head(200, {
-				"Content-Type": the_mime[0],
-				"Content-Length": str(content_length)
-			})
-		job.close_body(the_content)
+		return StaticContent(
+			the_content.encode("utf-8") if isinstance(the_content, str) \
+				else the_content,
+			the_mime[0] if the_mime is not None and the_mime[0] is not None \
+				else "application/octet-stream",
+			ospath.getmtime(file) if file is not None else None,
+			file is not None and fingerprint_regex.search(file) is not None)
 
+	static = LazyStaticContent(load)
 	return [
-		generate_endpoint("" if path == "/" else path, methods = {"GET": route}) \
-			for path in paths
+		generate_endpoint("" if path == "/" else path,
+			methods = {"GET": static.serve}) for path in paths
 	]
 
 def dump_json(obj, indent: Union[None, int, str] = "\t"):
@@ -0,0 +1,123 @@
+from gevent import Greenlet, sleep, spawn
+from gevent.event import AsyncResult
+from gevent.queue import Empty, Queue
+from time import monotonic
+from sys import stderr
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class WriteBehind:
+	"""Inserts documents in the background, group committing whatever was
+	submitted within `max_delay` seconds, up to `max_batch` documents at a time,
+	with a single call to `insert`. At most `max_queued` documents wait at once,
+	and `submit` blocks while the queue is full.
+
+	`insert` returns the error of each document that failed by its index, like
+	`Storage.insert_messages`. Documents must be append-only, a document that
+	already exists counts as written, which makes retrying safe. Documents that
+	fail are retried up to `max_retries` times, waiting twice as long before
+	each retry, and only then counted in `failed`.
+	"""
+
+	def __init__(self,
+			insert: Callable[[List[Dict[str, Any]]], Dict[int, BaseException]],
+			max_batch: int = 100, max_delay: float = 0.05, max_queued: int = 10000,
+			max_retries: int = 5, retry_delay: float = 0.1):
+		self.insert = insert
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.max_retries = max_retries
+		self.retry_delay = retry_delay
+		self.batches = 0
+		self.written = 0
+		self.retries = 0
+		self.failed = 0
+		self._queue: Queue = Queue(max_queued)
+		self._greenlet: Optional[Greenlet] = None
+
+	def start(self):
+		if self._greenlet is None or self._greenlet.dead:
+			self._greenlet = spawn(self._run)
+
+	def submit(self, document: Dict[str, Any]) -> AsyncResult:
+		"""Queues a document to be inserted. The returned result is set once the
+		batch containing it has been written, or holds the exception if writing
+		it failed.
+		"""
+
+		result = AsyncResult()
+		self._queue.put((document, result))
+		return result
+
+	def flush(self, timeout: Optional[float] = None) -> bool:
+		"""Waits for every document queued so far to be written, returning False if
+		`timeout` seconds pass first.
+		"""
+
+		# The queue is first in first out, so once an empty marker document is
+		# through everything before it is too.
+		result = AsyncResult()
+		self._queue.put(({}, result))
+		result.wait(timeout)
+		return result.ready()
+
+	def _next_batch(self) -> List[Tuple[Dict[str, Any], AsyncResult]]:
+		batch = [self._queue.get()]
+		deadline = monotonic() + self.max_delay
+		# Someone waiting on a flush marker shouldn't wait for the batch to fill.
+		while len(batch) < self.max_batch and len(batch[-1][0]) > 0:
+			remaining = deadline - monotonic()
+			if remaining <= 0:
+				break
+			try:
+				batch.append(self._queue.get(timeout = remaining))
+			except Empty:
+				break
+		return batch
+
+	def _write(self, documents: List[Dict[str, Any]]) -> \
+			Dict[int, BaseException]:
+		"""Inserts `documents`, retrying the ones that fail. Returns the error of
+		each document that still failed after the last retry, by its index.
+		"""
+
+		failures: Dict[int, BaseException] = {}
+		pending = list(range(len(documents)))
+		for attempt in range(self.max_retries + 1):
+			if attempt > 0:
+				self.retries += 1
+				sleep(self.retry_delay * 2 ** (attempt - 1))
+			try:
+				errors = self.insert([documents[ind] for ind in pending])
+			except Exception as error:
+				errors = {ind: error for ind in range(len(pending))}
+			failures = {pending[ind]: error for ind, error in errors.items()}
+			pending = sorted(failures)
+			if len(pending) == 0:
+				break
+		return failures
+
+	def _run(self):
+		while True:
+			batch = self._next_batch()
+			# Empty documents are only markers used by flush.
+			documents = [document for document, _ in batch if len(document) > 0]
+			failures = self._write(documents) if len(documents) > 0 else {}
+
+			if len(failures) > 0:
+				print(f"Failed to write {len(failures)} documents after " +
+					f"{self.max_retries} retries: " +
+					str(next(iter(failures.values()))), file = stderr)
+			self.batches += 1
+			self.written += len(documents) - len(failures)
+			self.failed += len(failures)
+			ind = 0
+			for document, result in batch:
+				if len(document) == 0:
+					result.set(None)
+					continue
+				failure = failures.get(ind)
+				if failure is None:
+					result.set(None)
+				else:
+					result.set_exception(failure)
+				ind += 1